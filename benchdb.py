@@ -0,0 +1,63 @@
+from game_backuper.db import (
+    ENCRYPTED_FILES_TABLE,
+    FILES_COLUMNS,
+    FILES_INDEX,
+    FILES_TABLE,
+    FILETYPE_TABLE,
+)
+from random import randrange
+from sqlite3 import connect
+from sys import argv
+from time import perf_counter
+
+
+rows = int(argv[1]) if len(argv) > 1 else 1000000
+OLD_FILES_TABLE = '''CREATE TABLE files (
+id INTEGER,
+file TEXT,
+size INT,
+program TEXT,
+hash TEXT,
+mtime INT,
+inode INT,
+ctime INT,
+PRIMARY KEY(id)
+);'''
+OLD_QUERY = 'SELECT files.id, files.file, files.size, files.program, files.hash, filetype.type, encrypted_files.key, encrypted_files.iv, encrypted_files.crc32, encrypted_files.compressed, encrypted_files.compressed_size, files.mtime, files.inode, files.ctime FROM files LEFT JOIN filetype ON files.id=filetype.id LEFT JOIN encrypted_files ON files.id=encrypted_files.id WHERE program=? AND file=?;'  # noqa: E501
+NEW_QUERY = f'SELECT {FILES_COLUMNS} FROM files WHERE program=? AND file=?;'
+
+
+def gen():
+    for i in range(rows):
+        yield (i + 1, f'dir{i % 1000}/file{i}.dat', i, f'prog{i % 10}', 'h')
+
+
+def bench(db, query, n):
+    t = perf_counter()
+    for _ in range(n):
+        i = randrange(rows)
+        r = db.execute(query, (f'prog{i % 10}', f'dir{i % 1000}/file{i}.dat')).fetchall()  # noqa: E501
+        assert len(r) == 1
+    return (perf_counter() - t) / n
+
+
+old = connect(':memory:')
+old.execute(OLD_FILES_TABLE)
+old.execute(FILETYPE_TABLE)
+old.execute(ENCRYPTED_FILES_TABLE)
+old.executemany('INSERT INTO files (id, file, size, program, hash) VALUES (?, ?, ?, ?, ?);', gen())  # noqa: E501
+old.executemany('INSERT INTO encrypted_files (id, key) VALUES (?, ?);', ((i, 'k') for i in range(1, rows + 1, 2)))  # noqa: E501
+old.commit()
+t = bench(old, OLD_QUERY, 20)
+print(f'Before: {t * 1000:.3f}ms per lookup ({rows} rows)')
+old.close()
+new = connect(':memory:')
+new.execute(FILES_TABLE)
+new.execute(FILES_INDEX)
+new.executemany('INSERT INTO files (id, file, size, program, hash) VALUES (?, ?, ?, ?, ?);', gen())  # noqa: E501
+new.execute('UPDATE files SET key=? WHERE id % 2 = 1;', ('k',))
+new.commit()
+t2 = bench(new, NEW_QUERY, 10000)
+print(f'After: {t2 * 1000:.3f}ms per lookup ({rows} rows)')
+print(f'Speedup: {t / t2:.0f}x')
+new.close()
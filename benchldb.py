@@ -0,0 +1,69 @@
+from game_backuper.leveldb import (
+    DB,
+    leveldb_to_sqlite,
+    list_leveldb_entries,
+)
+from os.path import join
+from shutil import rmtree
+from sqlite3 import connect
+from sys import argv
+from tempfile import mkdtemp
+from time import perf_counter
+
+
+keys = int(argv[1]) if len(argv) > 1 else 1000000
+DOMAINS = 100
+OLD_MAP_TABLE = '''CREATE TABLE map (
+key TEXT,
+value TEXT,
+PRIMARY KEY(key)
+)'''
+
+
+def old_leveldb_to_sqlite(db, dest, entries):
+    d = DB(db)
+    s = connect(dest)
+    s.text_factory = bytes
+    s.execute(OLD_MAP_TABLE)
+    for e in entries:
+        v = d.get(e)
+        if v is not None:
+            s.execute('INSERT INTO map VALUES (?, ?);', (e, v))
+    s.commit()
+    s.execute('VACUUM;')
+    s.commit()
+    d.close()
+    s.close()
+
+
+def dump(fn):
+    s = connect(fn)
+    s.text_factory = bytes
+    r = s.execute('SELECT key, value FROM map ORDER BY key;').fetchall()
+    s.close()
+    return r
+
+
+tmp = mkdtemp()
+try:
+    src = join(tmp, 'ldb')
+    d = DB(src, create_if_missing=True)
+    with d.write_batch() as b:
+        b.put(b'VERSION', b'1')
+        for i in range(DOMAINS):
+            b.put(b'META:site%d.com' % i, b'meta')
+        for i in range(keys):
+            b.put(b'_site%d.com\x00\x01key%d' % (i % DOMAINS, i), b'value%d' % i * 4)  # noqa: E501
+    d.close()
+    t = perf_counter()
+    old_leveldb_to_sqlite(src, join(tmp, 'old.db'), list_leveldb_entries(src))
+    t = perf_counter() - t
+    print(f'Before: {t:.2f}s ({keys} keys)')
+    t2 = perf_counter()
+    leveldb_to_sqlite(src, join(tmp, 'new.db'))
+    t2 = perf_counter() - t2
+    print(f'After: {t2:.2f}s')
+    assert dump(join(tmp, 'old.db')) == dump(join(tmp, 'new.db'))
+    print(f'Speedup: {t / t2:.1f}x')
+finally:
+    rmtree(tmp)
@@ -0,0 +1,64 @@
+from game_backuper.config import RuleMatcher, parse_ex_or_in_cludes
+from game_backuper.regexp import Regex
+from os.path import abspath, isabs, join, relpath
+from sys import argv
+from time import perf_counter
+
+
+paths = int(argv[1]) if len(argv) > 1 else 1000000
+BASE = '/data/save'
+RULES = parse_ex_or_in_cludes([
+    'cache/index.db',
+    'config.ini',
+    '/data/save/log.txt',
+    '/tmp/a.lock',
+    {'type': 'wildcards', 'rule': '*.tmp'},
+    {'type': 'wildcards', 'rule': '*/thumbs/*.png'},
+    {'type': 'wildcards', 'rule': 'shader?/*'},
+    {'type': 'regex', 'rule': r'.*\.bak$'},
+    {'type': 'regex', 'rule': r'crash/\d+\.dmp$'},
+    {'type': 'regex', 'rule': r'dir99\d/'},
+], False)
+
+
+def old_match(b, loc, e):
+    if isabs(loc):
+        bl = abspath(loc)
+        rl = relpath(loc, b)
+    else:
+        bl = abspath(join(b, loc))
+        rl = relpath(join(b, loc), b)
+    for i in e:
+        if isinstance(i, str):
+            if isabs(i):
+                if abspath(i) == bl:
+                    return True
+            else:
+                if relpath(join(b, i), b) == rl:
+                    return True
+        elif isinstance(i, Regex):
+            if i.match_only(rl):
+                return True
+            elif bl != loc and i.match_only(bl):
+                return True
+    return False
+
+
+def gen():
+    ext = ['dat', 'tmp', 'png', 'bak', 'sav']
+    for i in range(paths):
+        yield f'{BASE}/dir{i % 1000}/sub{i % 7}/file{i}.{ext[i % 5]}'
+
+
+li = list(gen())
+t = perf_counter()
+old = [old_match(BASE, i, RULES) for i in li]
+t = perf_counter() - t
+print(f'Before: {t:.2f}s ({paths} paths, {len(RULES)} rules)')
+m = RuleMatcher(RULES, BASE)
+t2 = perf_counter()
+new = [m.match(i) for i in li]
+t2 = perf_counter() - t2
+print(f'After: {t2:.2f}s')
+assert old == new
+print(f'Speedup: {t / t2:.1f}x, excluded: {sum(new)}')
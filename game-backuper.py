@@ -1,3 +1,7 @@
 # You can use `pyinstaller -c game-backuper.py` to get a package version
-from game_backuper import start
-start()
+if __name__ == "__main__":
+    # Workers of the process pool import this file again.
+    from multiprocessing import freeze_support
+    freeze_support()
+    from game_backuper import start
+    start()
@@ -0,0 +1 @@
+def find_cut(data: bytes, start: int, end: int, gear, min_size: int, avg_size: int, max_size: int, mask_s: int, mask_l: int) -> int: ...  # noqa: E501
@@ -0,0 +1,37 @@
+from libc.stdint cimport uint64_t
+
+
+cdef Py_ssize_t _find_cut(const unsigned char[:] data, Py_ssize_t start,
+                          Py_ssize_t normal, Py_ssize_t n,
+                          const uint64_t[:] gear, Py_ssize_t min_size,
+                          uint64_t mask_s, uint64_t mask_l) noexcept nogil:
+    cdef Py_ssize_t i = min_size
+    cdef uint64_t fp = 0
+    while i < normal:
+        fp = (fp << 1) + gear[data[start + i]]
+        if not (fp & mask_s):
+            return i + 1
+        i += 1
+    while i < n:
+        fp = (fp << 1) + gear[data[start + i]]
+        if not (fp & mask_l):
+            return i + 1
+        i += 1
+    return n
+
+
+def find_cut(const unsigned char[:] data, Py_ssize_t start, Py_ssize_t end,
+             const uint64_t[:] gear, Py_ssize_t min_size,
+             Py_ssize_t avg_size, Py_ssize_t max_size, uint64_t mask_s,
+             uint64_t mask_l):
+    cdef Py_ssize_t n = end - start
+    cdef Py_ssize_t normal
+    cdef Py_ssize_t r
+    if n <= min_size:
+        return n
+    if n > max_size:
+        n = max_size
+    normal = avg_size if avg_size < n else n
+    with nogil:
+        r = _find_cut(data, start, normal, n, gear, min_size, mask_s, mask_l)
+    return r
@@ -1,4 +1,7 @@
-from game_backuper.db import Db
+from concurrent.futures import ProcessPoolExecutor
+from functools import cached_property, partial
+from game_backuper.chunk import ChunkStore
+from game_backuper.db import Db, DbWriter
 from game_backuper.config import (
     Config,
     Program,
@@ -6,244 +9,104 @@ from game_backuper.config import (
     ConfigLeveldb,
 )
 from game_backuper.cml import Opts, OptAction
-from threading import Thread
-from os.path import exists, join, isdir
-from os import remove, close
+from os.path import exists, join, isdir, getsize
+from os import remove, close, cpu_count
 from shutil import move
 from game_backuper.file import new_file, copy_file, File, mkdir_for_file
+from game_backuper.file import DirCache, dir_state, get_dir_size
 from game_backuper.filetype import FileType
+from game_backuper.hashl import ALGORITHMS, algorithm_of, hash_file
 from game_backuper.restorer import RestoreTask
 from game_backuper.file import remove_compress_files, remove_unencryped_files
 from game_backuper.compress import compress
-from game_backuper.enc import encrypt_file
+from game_backuper.enc import encrypt_file, rekey
 from game_backuper.file import unpin_file_if_needed
+from game_backuper.scheduler import Scheduler, new_process_pool, run_in_pool
+from game_backuper.verifier import (
+    RateLimiter,
+    VerifyStats,
+    VerifyTask,
+    find_orphans,
+)
 from tempfile import mkstemp
+from typing import Dict, Set, Tuple
 
 
-class BackupTask(Thread):
-    def __init__(self, prog: Program, db: Db, cfg: Config):
-        Thread.__init__(self, name=f"Backup_{prog.name}")
+class BackupTask:
+    def __init__(self, prog: Program, db: Db, cfg: Config, opts: Opts,
+                 writer: DbWriter, pool: ProcessPoolExecutor = None,
+                 store: ChunkStore = None, paths: Set[str] = None,
+                 dir_cache: DirCache = None,
+                 leveldb_states: Dict[str, dict] = None):
+        '''If paths is given, only files at these paths are backed up
+        instead of scanning all files of prog. If leveldb_states is given,
+        the state of each leveldb directory after it is closed is stored in
+        it.'''
+        self.name = f"Backup_{prog.name}"
         self.cfg = cfg
         self.prog = prog
         self.db = db
+        self.opts = opts
+        self.writer = writer
+        self.pool = pool
+        self.store = store if store else ChunkStore(cfg.dest, db, writer)
+        self.workers = prog.workers
+        self.paths = paths
+        self.dir_cache = dir_cache
+        self.leveldb_states = leveldb_states
 
-    def run(self):
-        self.prog.clear_cache()
-        prog = self.prog.name
-        bp = join(self.cfg.dest, prog)
-        ebp = join(self.cfg.dest, '.encrypt', prog)
-        ebpi = join(self.cfg.dest, '.encrypt', '.id')
-        fl = self.db.get_file_list(prog)
-        for f in self.prog.files:
+    def jobs(self):
+        self._index = self.db.load_program_index(self.prog.name)
+        if self.paths is None:
+            files = self.prog.iter_files(self.dir_cache)
+            scope = self._index.keys()
+        else:
+            files = {}
+            for p in self.paths:
+                f = self.prog.resolve_file(p)
+                if f is not None:
+                    files[f.name] = f
+            scope = self._index.keys() & files.keys()
+            files = files.values()
+        names = set()
+        for f in files:
             if isinstance(f, ConfigNormalFile):
-                if exists(f[1]):
-                    if f.name in fl:
-                        fl.remove(f.name)
-                    c = f.compress_config
-                    ori = self.db.get_file(prog, f[0])
-                    nf = new_file(f[1], f[0], prog)
-                    if nf is None:
+                if f.stat is not None:
+                    size = f.stat.st_size
+                else:
+                    try:
+                        size = getsize(f.full_path)
+                    except OSError:
                         continue
-                    de = join(ebp if f.encrypt_files else bp, f[0])
-                    if ori is not None:
-                        de2 = join(ebpi if f.encrypt_files else bp, str(ori.id))  # noqa: E501
-                        if f.protect_filename:
-                            if not exists(de2) and exists(de):
-                                mkdir_for_file(de2)
-                                move(de, de2)
-                                print(f'{prog}: Renamed {de} -> {de2}.')
-                            de = de2
-                        else:
-                            if not exists(de) and exists(de2):
-                                mkdir_for_file(de)
-                                move(de2, de)
-                                print(f'{prog}: Renamed {de2} -> {de}.')
-                        if ori.size == nf.size and ori.hash == nf.hash:
-                            if c is None:
-                                if exists(de) and not f.encrypt_files:
-                                    print(f'{prog}: Skip {f[0]}.')
-                                    remove_compress_files(de, prog, f.name)
-                                    self.remove_encrypted_file(join(ebp, f[0]), prog, f.name, ori)  # noqa: E501
-                                    self.remove_encrypted_file(join(ebpi, str(ori.id)), prog, f.name, ori)  # noqa: E501
-                                    if f.unpin_file:
-                                        unpin_file_if_needed(de)
-                                    continue
-                                elif exists(de) and f.encrypt_files and not ori.compressed:  # noqa: E501
-                                    print(f'{prog}: Skip {f[0]}.')
-                                    remove_unencryped_files(join(bp, f[0]), prog, f.name)  # noqa: E501
-                                    if f.unpin_file:
-                                        unpin_file_if_needed(de)
-                                    continue
-                            else:
-                                if not f.encrypt_files and exists(de + c.ext):
-                                    print(f'{prog}: Skip {f.name}.')
-                                    remove_compress_files(de, prog, f.name, c.ext)  # noqa: E501
-                                    self.remove_encrypted_file(join(ebp, f[0]), prog, f.name, ori)  # noqa: E501
-                                    self.remove_encrypted_file(join(ebpi, str(ori.id)), prog, f.name, ori)  # noqa: E501
-                                    if f.unpin_file:
-                                        unpin_file_if_needed(de + c.ext)
-                                    continue
-                                elif f.encrypt_files and ori.compressed_type == c.method:  # noqa: E501
-                                    print(f'{prog}: Skip {f.name}.')
-                                    remove_unencryped_files(join(bp, f.name), prog, f.name)  # noqa: E501
-                                    if f.unpin_file:
-                                        unpin_file_if_needed(de)
-                                    continue
-                        stats = None
-                        if f.encrypt_files:
-                            stats = encrypt_file(f[1], de, nf, f.name, prog, c)
-                            remove_unencryped_files(join(bp, f[0]), prog, f.name)  # noqa: E501
-                        elif c is None:
-                            copy_file(f[1], de, f[0], prog)
-                            remove_compress_files(de, prog, f.name)
-                            self.remove_encrypted_file(join(ebp, f[0]), prog, f.name, ori)  # noqa: E501
-                            self.remove_encrypted_file(join(ebpi, str(ori.id)), prog, f.name, ori)  # noqa: E501
-                        else:
-                            compress(f[1], de, c, f.name, prog)
-                            self.remove_encrypted_file(join(ebp, f[0]), prog, f.name, ori)  # noqa: E501
-                            self.remove_encrypted_file(join(ebpi, str(ori.id)), prog, f.name, ori)  # noqa: E501
-                        self.db.set_file(ori.id, nf.size, nf.hash)
-                        self.db.set_file_encrypt_information(ori.id, stats)
-                        if f.unpin_file:
-                            unpin_file_if_needed(de)
-                    else:
-                        if f.protect_filename:
-                            self.db.add_file(nf, False)
-                            tmpori = self.db.get_file(prog, f[0])
-                            de = join(ebpi if f.encrypt_files else bp, str(tmpori.id))  # noqa: E501
-                        if f.encrypt_files:
-                            s = encrypt_file(f[1], de, nf, f.name, prog, c)
-                            nf = File.from_encrypt_stats(s, nf)
-                            remove_unencryped_files(join(bp, f[0]), prog, f.name)  # noqa: E501
-                        elif c is None:
-                            copy_file(f[1], de, f[0], prog)
-                            remove_compress_files(de, prog, f.name)
-                            self.remove_encrypted_file(join(ebp, f[0]), prog, f.name, ori)  # noqa: E501
-                        else:
-                            compress(f[1], de, c, f.name, prog)
-                            self.remove_encrypted_file(join(ebp, f[0]), prog, f.name, ori)  # noqa: E501
-                        if f.protect_filename:
-                            self.db.set_file_encrypt_information(tmpori.id, s)
-                        else:
-                            self.db.add_file(nf)
-                        if f.unpin_file:
-                            unpin_file_if_needed(de)
+                func = self.backup_file
             elif isinstance(f, ConfigLeveldb):
                 from game_backuper.leveldb import have_leveldb
                 if not have_leveldb:
                     raise NotImplementedError('Leveldb is not supported.')
                 if not exists(f.full_path):
                     continue
-                if f.name in fl:
-                    fl.remove(f.name)
-                from game_backuper.leveldb import (
-                    list_leveldb_entries,
-                    leveldb_stats,
-                    leveldb_to_sqlite,
-                )
-                ent = list_leveldb_entries(f.full_path, f.domains)
-                stats = leveldb_stats(f.full_path, ent)
-                ori = self.db.get_file(prog, f.name)
-                c = f.compress_config
-                de = join(ebp if f.encrypt_files else bp, f.name + ".db")
-                if ori is not None:
-                    de2 = join(ebpi if f.encrypt_files else bp, str(ori.id))  # noqa: E501
-                    if f.protect_filename:
-                        if not exists(de2) and exists(de):
-                            mkdir_for_file(de2)
-                            move(de, de2)
-                            print(f'{prog}: Renamed {de} -> {de2}.')
-                        de = de2
-                    else:
-                        if not exists(de) and exists(de2):
-                            mkdir_for_file(de)
-                            move(de2, de)
-                            print(f'{prog}: Renamed {de2} -> {de}.')
-                    if ori.type is None or ori.type != FileType.LEVELDB:
-                        pp = join(bp, ori.file)
-                        if exists(pp):
-                            remove(pp)
-                        remove_compress_files(pp, prog, f.name)
-                        self.remove_encrypted_file(join(ebp, ori.file), prog, f.name, ori)  # noqa: E501
-                        self.remove_encrypted_file(join(ebpi, str(ori.id)), prog, f.name, ori)  # noqa: E501
-                        self.db.remove_file(ori)
-                        ori = None
-                if ori is not None:
-                    if ori.size == stats.size and ori.hash == stats.hash:
-                        if c is None:
-                            if exists(de) and not f.encrypt_files:
-                                print(f'{prog}: Skip {f[0]}.')
-                                remove_compress_files(de, prog, f.name)
-                                self.remove_encrypted_file(join(ebp, f[0] + '.db'), prog, f.name, ori)  # noqa: E501
-                                self.remove_encrypted_file(join(ebpi, str(ori.id)), prog, f.name, ori)  # noqa: E501
-                                if f.unpin_file:
-                                    unpin_file_if_needed(de)
-                                continue
-                            elif exists(de) and f.encrypt_files and not ori.compressed:  # noqa: E501
-                                print(f'{prog}: Skip {f[0]}.')
-                                remove_unencryped_files(join(bp, f[0] + '.db'), prog, f.name)  # noqa: E501
-                                if f.unpin_file:
-                                    unpin_file_if_needed(de)
-                                continue
-                        else:
-                            if not f.encrypt_files and exists(de + c.ext):
-                                print(f'{prog}: Skip {f.name}.')
-                                remove_compress_files(de, prog, f.name, c.ext)
-                                self.remove_encrypted_file(join(ebp, f[0] + '.db'), prog, f.name, ori)  # noqa: E501
-                                self.remove_encrypted_file(join(ebpi, str(ori.id)), prog, f.name, ori)  # noqa: E501
-                                if f.unpin_file:
-                                    unpin_file_if_needed(de + c.ext)
-                                continue
-                            elif f.encrypt_files and ori.compressed_type == c.method:  # noqa: E501
-                                print(f'{prog}: Skip {f.name}.')
-                                remove_unencryped_files(join(bp, f.name + '.db'), prog, f.name)  # noqa: E501
-                                if f.unpin_file:
-                                    unpin_file_if_needed(de)
-                                continue
-                if f.protect_filename:
-                    ori = self.db.get_file(prog, f[0])
-                    if ori is None:
-                        nf = File(None, f.name, 0, prog, None, FileType.LEVELDB, None, None, None, None, None)  # noqa: E501
-                        self.db.add_file(nf, False)
-                        ori = self.db.get_file(prog, f[0])
-                    de = join(ebpi if f.encrypt_files else bp, str(ori.id))  # noqa: E501
-                mkdir_for_file(de)
-                st = None
-                if c is None and not f.encrypt_files:
-                    leveldb_to_sqlite(f.full_path, de, ent)
-                    print(f'{prog}: Covert leveldb done. {f.full_path}({f.name}) -> {de}')  # noqa: E501
-                    remove_compress_files(de, prog, f.name)
-                    self.remove_encrypted_file(join(ebp, f[0] + '.db'), prog, f.name, ori)  # noqa: E501
-                    self.remove_encrypted_file(join(ebpi, str(ori.id)), prog, f.name, ori)  # noqa: E501
-                else:
-                    tmp = mkstemp()
-                    close(tmp[0])
-                    tmp = tmp[1]
-                    leveldb_to_sqlite(f.full_path, tmp, ent)
-                    print(f'{prog}: Covert leveldb done. {f.full_path}({f.name}) -> {tmp}')  # noqa: E501
-                    if f.encrypt_files:
-                        st = encrypt_file(tmp, de, File.from_leveldb_stats(stats), f.name, prog, c)  # noqa: E501
-                        remove_unencryped_files(join(bp, f[0] + '.db'), prog, f.name)  # noqa: E501
-                    else:
-                        compress(tmp, de, c, f.name, prog)
-                        self.remove_encrypted_file(join(ebp, f[0] + '.db'), prog, f.name, ori)  # noqa: E501
-                        self.remove_encrypted_file(join(ebpi, str(ori.id)), prog, f.name, ori)  # noqa: E501
-                    remove(tmp)
-                    print(f'{prog}: Removed tempfile {tmp}')
-                if ori is None:
-                    nf = File(None, f.name, stats.size, prog, stats.hash,
-                              FileType.LEVELDB, None, None, None, None, None)
-                    if st:
-                        nf = File.from_encrypt_stats(st, nf)
-                    self.db.add_file(nf)
-                else:
-                    self.db.set_file(ori.id, stats.size, stats.hash)
-                    self.db.set_file_encrypt_information(ori.id, st)
-                if f.unpin_file:
-                    unpin_file_if_needed(de)
-        for fn in fl:
-            f = self.db.get_file(prog, fn)
-            if f.type is None:
+                size = get_dir_size(f.full_path)
+                func = self.backup_leveldb
+            else:
+                continue
+            names.add(f.name)
+            yield size, partial(self.run_job, func), f
+        self._fl = scope - names
+        if self.dir_cache is not None:
+            dirs = self.dir_cache.pop_updated()
+            if dirs:
+                self.writer.submit(self.db.set_dirs, dirs)
+
+    def finish(self):
+        prog = self.prog.name
+        if self.paths is None and self.dir_cache is not None:
+            self.dir_cache.complete(prog)
+        bp = join(self.cfg.dest, prog)
+        ebp = join(self.cfg.dest, '.encrypt', prog)
+        ebpi = join(self.cfg.dest, '.encrypt', '.id')
+        for fn in self._fl:
+            f = self._index[fn]
+            if f.type is None or f.type == FileType.CHUNKED:
                 de = join(bp, fn)
                 if exists(de):
                     remove(de)
@@ -251,16 +114,317 @@ class BackupTask(Thread):
                 remove_compress_files(de, prog, fn)
                 self.remove_encrypted_file(join(ebp, fn), prog, fn, f)
                 self.remove_encrypted_file(join(ebpi, str(f.id)), prog, fn, f)
-                self.db.remove_file(f)
+                self.writer.submit(self.db.remove_file, f)
             if f.type == FileType.LEVELDB:
                 de = join(bp, fn + '.db')
                 if exists(de):
                     remove(de)
                     print(f'{prog}: Remove {de}({fn})')
                 remove_compress_files(de, prog, fn + '.db')
-                self.remove_encrypted_file(join(ebp, fn + '.db'), prog, fn, f)
-                self.remove_encrypted_file(join(ebpi, str(f.id)), prog, fn, ori)  # noqa: E501
-                self.db.remove_file(f)
+                self.remove_encrypted_file(join(ebp, fn + '.db'), prog, fn, f)  # noqa: E501
+                self.remove_encrypted_file(join(ebpi, str(f.id)), prog, fn, f)
+                self.writer.submit(self.db.remove_file, f)
+
+    def backup_file(self, f: ConfigNormalFile):
+        prog = self.prog.name
+        bp = join(self.cfg.dest, prog)
+        ebp = join(self.cfg.dest, '.encrypt', prog)
+        ebpi = join(self.cfg.dest, '.encrypt', '.id')
+        c = f.compress_config
+        alg = self.cfg.hash_algorithm
+        ori = self._index.get(f.name)
+        nf = new_file(f[1], f[0], prog, cached=None if self.opts.paranoid else ori, hash=False, st=f.stat)  # noqa: E501
+        if nf is None:
+            return
+        if nf.hash is None and ori is not None and ori.size == nf.size:
+            # File may be unchanged. Hash it first to avoid writing it again
+            nf, ori = self.hash_file(f, nf, ori)
+        # Otherwise the hash is computed while writing the file
+        h = nf.hash is None
+        if f.chunked:
+            return self.backup_chunked_file(f, ori, nf)
+        de = join(ebp if f.encrypt_files else bp, f[0])
+        if ori is not None:
+            de2 = join(ebpi if f.encrypt_files else bp, str(ori.id))
+            if f.protect_filename:
+                if not exists(de2) and exists(de):
+                    mkdir_for_file(de2)
+                    move(de, de2)
+                    print(f'{prog}: Renamed {de} -> {de2}.')
+                de = de2
+            else:
+                if not exists(de) and exists(de2):
+                    mkdir_for_file(de)
+                    move(de2, de)
+                    print(f'{prog}: Renamed {de2} -> {de}.')
+            if ori.size == nf.size and ori.hash == nf.hash and ori.type != FileType.CHUNKED:  # noqa: E501
+                if ori.stat_tuple != nf.stat_tuple:
+                    self.writer.submit(self.db.set_file, ori.id, nf.size, nf.hash, nf.mtime, nf.inode, nf.ctime)  # noqa: E501
+                if c is None:
+                    if exists(de) and not f.encrypt_files:
+                        print(f'{prog}: Skip {f[0]}.')
+                        remove_compress_files(de, prog, f.name)
+                        self.remove_encrypted_file(join(ebp, f[0]), prog, f.name, ori)  # noqa: E501
+                        self.remove_encrypted_file(join(ebpi, str(ori.id)), prog, f.name, ori)  # noqa: E501
+                        if f.unpin_file:
+                            unpin_file_if_needed(de)
+                        return
+                    elif exists(de) and f.encrypt_files and not ori.compressed:
+                        print(f'{prog}: Skip {f[0]}.')
+                        remove_unencryped_files(join(bp, f[0]), prog, f.name)
+                        if f.unpin_file:
+                            unpin_file_if_needed(de)
+                        return
+                else:
+                    if not f.encrypt_files and exists(de + c.ext):
+                        print(f'{prog}: Skip {f.name}.')
+                        remove_compress_files(de, prog, f.name, c.ext)
+                        self.remove_encrypted_file(join(ebp, f[0]), prog, f.name, ori)  # noqa: E501
+                        self.remove_encrypted_file(join(ebpi, str(ori.id)), prog, f.name, ori)  # noqa: E501
+                        if f.unpin_file:
+                            unpin_file_if_needed(de + c.ext)
+                        return
+                    elif f.encrypt_files and ori.compressed_type == c.method:
+                        print(f'{prog}: Skip {f.name}.')
+                        remove_unencryped_files(join(bp, f.name), prog, f.name)
+                        if f.unpin_file:
+                            unpin_file_if_needed(de)
+                        return
+            stats = None
+            hs = None
+            if f.encrypt_files:
+                stats = run_in_pool(self.pool, encrypt_file, f[1], de, nf, f.name, prog, c, h, alg)  # noqa: E501
+                if h:
+                    stats, hs = stats
+                remove_unencryped_files(join(bp, f[0]), prog, f.name)
+            elif c is None:
+                hs = copy_file(f[1], de, f[0], prog, h, alg)
+                remove_compress_files(de, prog, f.name)
+                self.remove_encrypted_file(join(ebp, f[0]), prog, f.name, ori)
+                self.remove_encrypted_file(join(ebpi, str(ori.id)), prog, f.name, ori)  # noqa: E501
+            else:
+                hs = run_in_pool(self.pool, compress, f[1], de, c, f.name, prog, h, alg)  # noqa: E501
+                self.remove_encrypted_file(join(ebp, f[0]), prog, f.name, ori)
+                self.remove_encrypted_file(join(ebpi, str(ori.id)), prog, f.name, ori)  # noqa: E501
+            if h:
+                nf = nf._replace(hash=hs)
+            if ori.type == FileType.CHUNKED:
+                self.writer.submit(self.db.set_file_type, ori.id, None)
+                self.writer.submit(self.db.set_file_chunks, ori.id, [])
+            self.writer.submit(self.db.set_file, ori.id, nf.size, nf.hash, nf.mtime, nf.inode, nf.ctime)  # noqa: E501
+            self.writer.submit(self.db.set_file_encrypt_information, ori.id, stats)  # noqa: E501
+            if f.unpin_file:
+                unpin_file_if_needed(de)
+        else:
+            if f.protect_filename:
+                id = self.writer.submit(self.db.add_file, nf, False).result()
+                de = join(ebpi if f.encrypt_files else bp, str(id))
+            if f.encrypt_files:
+                s, hs = run_in_pool(self.pool, encrypt_file, f[1], de, nf, f.name, prog, c, True, alg)  # noqa: E501
+                nf = File.from_encrypt_stats(s, nf._replace(hash=hs))
+                remove_unencryped_files(join(bp, f[0]), prog, f.name)
+            elif c is None:
+                hs = copy_file(f[1], de, f[0], prog, True, alg)
+                nf = nf._replace(hash=hs)
+                remove_compress_files(de, prog, f.name)
+                self.remove_encrypted_file(join(ebp, f[0]), prog, f.name, ori)
+            else:
+                hs = run_in_pool(self.pool, compress, f[1], de, c, f.name, prog, True, alg)  # noqa: E501
+                nf = nf._replace(hash=hs)
+                self.remove_encrypted_file(join(ebp, f[0]), prog, f.name, ori)
+            if f.protect_filename:
+                self.writer.submit(self.db.set_file, id, nf.size, nf.hash, nf.mtime, nf.inode, nf.ctime)  # noqa: E501
+                self.writer.submit(self.db.set_file_encrypt_information, id, s)  # noqa: E501
+            else:
+                self.writer.submit(self.db.add_file, nf)
+            if f.unpin_file:
+                unpin_file_if_needed(de)
+
+    def backup_chunked_file(self, f: ConfigNormalFile, ori: File, nf: File):
+        prog = self.prog.name
+        bp = join(self.cfg.dest, prog)
+        ebp = join(self.cfg.dest, '.encrypt', prog)
+        ebpi = join(self.cfg.dest, '.encrypt', '.id')
+        if ori is not None and ori.type == FileType.CHUNKED:
+            if ori.size == nf.size and ori.hash == nf.hash and not (f.encrypt_files and ori.id in self.plain_chunked):  # noqa: E501
+                if ori.stat_tuple != nf.stat_tuple:
+                    self.writer.submit(self.db.set_file, ori.id, nf.size, nf.hash, nf.mtime, nf.inode, nf.ctime)  # noqa: E501
+                print(f'{prog}: Skip {f.name}.')
+                return
+        hs, chunks = self.store.store_file(f.full_path, f.compress_config,
+                                           f.encrypt_files,
+                                           self.cfg.hash_algorithm)
+        nf = nf._replace(hash=hs, type=FileType.CHUNKED)
+        if ori is None:
+            id = self.writer.submit(self.db.add_file, nf, False).result()
+        else:
+            id = ori.id
+            self.writer.submit(self.db.set_file, id, nf.size, nf.hash, nf.mtime, nf.inode, nf.ctime)  # noqa: E501
+            self.writer.submit(self.db.set_file_type, id, FileType.CHUNKED)
+            self.writer.submit(self.db.set_file_encrypt_information, id, None)
+        self.writer.submit(self.db.set_file_chunks, id, chunks)
+        print(f'{prog}: Stored {f.full_path}({f.name}) as {len(chunks)} chunks.')  # noqa: E501
+        remove_unencryped_files(join(bp, f.name), prog, f.name)
+        self.remove_encrypted_file(join(ebp, f.name), prog, f.name, ori)
+        self.remove_encrypted_file(join(ebpi, str(id)), prog, f.name, ori)
+
+    def backup_leveldb(self, f: ConfigLeveldb):
+        from game_backuper.leveldb import leveldb_to_sqlite
+        tmp = mkstemp()
+        close(tmp[0])
+        tmp = tmp[1]
+        try:
+            # Export a snapshot once. Stats are computed in the same pass
+            # and the export is only kept if the leveldb is changed.
+            try:
+                stats = leveldb_to_sqlite(f.full_path, tmp, f.domains)
+            finally:
+                # Opening a leveldb writes to its directory.
+                if self.leveldb_states is not None:
+                    self.leveldb_states[f.full_path] = dir_state(f.full_path)
+            self.store_leveldb(f, tmp, stats)
+        finally:
+            if exists(tmp):
+                remove(tmp)
+
+    def store_leveldb(self, f: ConfigLeveldb, tmp: str, stats):
+        '''Store leveldb f exported to tmp if stats is changed.'''
+        prog = self.prog.name
+        bp = join(self.cfg.dest, prog)
+        ebp = join(self.cfg.dest, '.encrypt', prog)
+        ebpi = join(self.cfg.dest, '.encrypt', '.id')
+        ori = self._index.get(f.name)
+        c = f.compress_config
+        de = join(ebp if f.encrypt_files else bp, f.name + ".db")
+        if ori is not None:
+            de2 = join(ebpi if f.encrypt_files else bp, str(ori.id))
+            if f.protect_filename:
+                if not exists(de2) and exists(de):
+                    mkdir_for_file(de2)
+                    move(de, de2)
+                    print(f'{prog}: Renamed {de} -> {de2}.')
+                de = de2
+            else:
+                if not exists(de) and exists(de2):
+                    mkdir_for_file(de)
+                    move(de2, de)
+                    print(f'{prog}: Renamed {de2} -> {de}.')
+            if ori.type is None or ori.type != FileType.LEVELDB:
+                pp = join(bp, ori.file)
+                if exists(pp):
+                    remove(pp)
+                remove_compress_files(pp, prog, f.name)
+                self.remove_encrypted_file(join(ebp, ori.file), prog, f.name, ori)  # noqa: E501
+                self.remove_encrypted_file(join(ebpi, str(ori.id)), prog, f.name, ori)  # noqa: E501
+                self.writer.submit(self.db.remove_file, ori).result()
+                ori = None
+        if ori is not None:
+            if ori.size == stats.size and ori.hash == stats.hash:
+                if c is None:
+                    if exists(de) and not f.encrypt_files:
+                        print(f'{prog}: Skip {f[0]}.')
+                        remove_compress_files(de, prog, f.name)
+                        self.remove_encrypted_file(join(ebp, f[0] + '.db'), prog, f.name, ori)  # noqa: E501
+                        self.remove_encrypted_file(join(ebpi, str(ori.id)), prog, f.name, ori)  # noqa: E501
+                        if f.unpin_file:
+                            unpin_file_if_needed(de)
+                        return
+                    elif exists(de) and f.encrypt_files and not ori.compressed:
+                        print(f'{prog}: Skip {f[0]}.')
+                        remove_unencryped_files(join(bp, f[0] + '.db'), prog, f.name)  # noqa: E501
+                        if f.unpin_file:
+                            unpin_file_if_needed(de)
+                        return
+                else:
+                    if not f.encrypt_files and exists(de + c.ext):
+                        print(f'{prog}: Skip {f.name}.')
+                        remove_compress_files(de, prog, f.name, c.ext)
+                        self.remove_encrypted_file(join(ebp, f[0] + '.db'), prog, f.name, ori)  # noqa: E501
+                        self.remove_encrypted_file(join(ebpi, str(ori.id)), prog, f.name, ori)  # noqa: E501
+                        if f.unpin_file:
+                            unpin_file_if_needed(de + c.ext)
+                        return
+                    elif f.encrypt_files and ori.compressed_type == c.method:
+                        print(f'{prog}: Skip {f.name}.')
+                        remove_unencryped_files(join(bp, f.name + '.db'), prog, f.name)  # noqa: E501
+                        if f.unpin_file:
+                            unpin_file_if_needed(de)
+                        return
+        if f.protect_filename:
+            if ori is None:
+                nf = File(None, f.name, 0, prog, None, FileType.LEVELDB, None, None, None, None, None)  # noqa: E501
+                id = self.writer.submit(self.db.add_file, nf, False).result()
+                ori = nf._replace(id=id)
+            de = join(ebpi if f.encrypt_files else bp, str(ori.id))
+        mkdir_for_file(de)
+        st = None
+        print(f'{prog}: Covert leveldb done. {f.full_path}({f.name}) -> {tmp}')  # noqa: E501
+        if c is None and not f.encrypt_files:
+            if exists(de):
+                remove(de)
+            move(tmp, de)
+            print(f'{prog}: Moved {tmp} -> {de}')
+            remove_compress_files(de, prog, f.name)
+            self.remove_encrypted_file(join(ebp, f[0] + '.db'), prog, f.name, ori)  # noqa: E501
+            if ori is not None:
+                self.remove_encrypted_file(join(ebpi, str(ori.id)), prog, f.name, ori)  # noqa: E501
+        elif f.encrypt_files:
+            st = run_in_pool(self.pool, encrypt_file, tmp, de, File.from_leveldb_stats(stats), f.name, prog, c)  # noqa: E501
+            remove_unencryped_files(join(bp, f[0] + '.db'), prog, f.name)
+        else:
+            run_in_pool(self.pool, compress, tmp, de, c, f.name, prog)
+            self.remove_encrypted_file(join(ebp, f[0] + '.db'), prog, f.name, ori)  # noqa: E501
+            if ori is not None:
+                self.remove_encrypted_file(join(ebpi, str(ori.id)), prog, f.name, ori)  # noqa: E501
+        if ori is None:
+            nf = File(None, f.name, stats.size, prog, stats.hash,
+                      FileType.LEVELDB, None, None, None, None, None)
+            if st:
+                nf = File.from_encrypt_stats(st, nf)
+            self.writer.submit(self.db.add_file, nf)
+        else:
+            self.writer.submit(self.db.set_file, ori.id, stats.size, stats.hash)  # noqa: E501
+            self.writer.submit(self.db.set_file_encrypt_information, ori.id, st)  # noqa: E501
+        if f.unpin_file:
+            unpin_file_if_needed(de)
+
+    def hash_file(self, f: ConfigNormalFile, nf: File,
+                  ori: File) -> Tuple[File, File]:
+        '''Hash f with the configured algorithm. If ori is hashed with another
+        algorithm, f is hashed with both in one pass. If f is unchanged, ori
+        is re-keyed to the new hash, so old rows are migrated when f is read
+        anyway. Return (nf, ori) with the new hashes.'''
+        alg = self.cfg.hash_algorithm
+        old = algorithm_of(ori.hash)
+        with open(f[1], 'rb') as fp:
+            if old == alg or old not in ALGORITHMS:
+                return nf._replace(hash=hash_file(fp, alg)[0]), ori
+            hs, ohs = hash_file(fp, alg, old)
+        nf = nf._replace(hash=hs)
+        if ohs != ori.hash:
+            return nf, ori
+        key = None
+        if ori.encrypted and ori.type != FileType.CHUNKED:
+            key = rekey(ori.key, ori.hash, hs)
+        self.writer.submit(self.db.set_file_hash, ori.id, hs, key)
+        print(f'{self.prog.name}: Rehashed {f.name} with {alg}.')
+        return nf, ori._replace(hash=hs, key=key or ori.key)
+
+    @cached_property
+    def plain_chunked(self) -> Set[int]:
+        '''Ids of chunked files which use unencrypted chunks. They are
+        stored again if they should be encrypted.'''
+        return self.db.get_files_with_plain_chunks(self.prog.name)
+
+    def run_job(self, func, f):
+        try:
+            # Mutations of f are applied together, so a commit never
+            # contains a part of them.
+            with self.writer.group():
+                func(f)
+        finally:
+            # All mutations of f are queued, commit here if batch is full.
+            self.writer.submit(self.db.checkpoint)
 
     def remove_encrypted_file(self, loc: str, prog: str, name: str, f: File):
         if exists(loc):
@@ -273,19 +437,51 @@ class Backuper:
         self.db = db
         self.conf = config
         self.opts = opts
-        self.tasks = []
+        jobs = opts.jobs if opts.jobs is not None else config.max_jobs
+        self._jobs = jobs if jobs is not None else cpu_count() or 1
+        self.scheduler = Scheduler(self._jobs)
+        self.writer = None
+        processes = opts.processes
+        if processes is None:
+            processes = config.process_workers
+        self.pool = new_process_pool(processes) if processes else None
+        self.store = None
+        self.dir_cache = None
+        # leveldb directory -> state after it is backed up. Used by watcher.
+        self.leveldb_states = {}
+        self.verify_stats = VerifyStats()
+        self.limiter = None
+        if opts.rate_limit is not None:
+            self.limiter = RateLimiter(opts.rate_limit)
 
-    def deal_prog(self, prog: Program):
-        if self.opts.action == OptAction.BACKUP:
-            t = BackupTask(prog, self.db, self.conf)
-            self.tasks.append(t)
-            t.start()
+    def deal_prog(self, prog: Program, paths: Set[str] = None):
+        if self.opts.action in (OptAction.BACKUP, OptAction.WATCH):
+            if self.writer is None:
+                self.writer = DbWriter(self.db)
+                self.writer.start()
+                self.store = ChunkStore(self.conf.dest, self.db, self.writer)
+            if self.dir_cache is None:
+                self.dir_cache = DirCache(self.db.get_dirs(), self.opts.rescan)
+            t = BackupTask(prog, self.db, self.conf, self.opts, self.writer,
+                           self.pool, self.store, paths, self.dir_cache,
+                           self.leveldb_states)
+            self.scheduler.add_task(t)
         elif self.opts.action == OptAction.LIST:
             print(prog.name)
         elif self.opts.action == OptAction.RESTORE:
-            t = RestoreTask(prog, self.db, self.conf)
-            self.tasks.append(t)
-            t.start()
+            if self.store is None:
+                self.store = ChunkStore(self.conf.dest, self.db)
+            t = RestoreTask(prog, self.db, self.conf, self.opts, self.pool,
+                            self.store)
+            self.scheduler.add_task(t)
+        elif self.opts.action == OptAction.VERIFY:
+            if self.writer is None:
+                self.writer = DbWriter(self.db)
+                self.writer.start()
+                self.store = ChunkStore(self.conf.dest, self.db)
+            t = VerifyTask(prog, self.db, self.conf, self.opts, self.writer,
+                           self.verify_stats, self.limiter, self.store)
+            self.scheduler.add_task(t)
 
     def run(self):
         if self.opts.action == OptAction.LIST_LEVELDB_KEY:
@@ -303,19 +499,51 @@ class Backuper:
                         raise FileExistsError(f'"{db}" should be a directory.')
                 else:
                     raise FileNotFoundError(f'Can not find "{db}"')
-        elif self.opts.programs_list is None:
-            for prog in self.conf.progs:
-                self.deal_prog(prog)
+            return 0
+        if self.opts.programs_list is None:
+            progs = self.conf.progs
         else:
             for n in self.opts.programs_list:
                 if n not in self.conf.progs_name:
                     raise ValueError(f'Can not find "{n}" in config file.')
-            for n in self.opts.programs_list:
-                prog = self.conf.progs[self.conf.progs_name.index(n)]
-                self.deal_prog(prog)
+            progs = [self.conf.progs[self.conf.progs_name.index(n)]
+                     for n in self.opts.programs_list]
+        if self.opts.action == OptAction.WATCH:
+            from game_backuper.watcher import Watcher
+            try:
+                Watcher(self, progs).run()
+            finally:
+                if self.pool is not None:
+                    self.pool.shutdown()
+            return 0
+        for prog in progs:
+            self.deal_prog(prog)
         self.wait()
+        if self.opts.action == OptAction.VERIFY:
+            find_orphans(self.conf, self.db, self.verify_stats)
+            print(self.verify_stats)
+            return 0 if self.verify_stats.ok else 1
         return 0
 
-    def wait(self):
-        for task in self.tasks:
-            task.join()
+    def wait(self, shutdown: bool = True):
+        '''Run all added tasks. If shutdown is False, the process pool is
+        kept and new tasks can be added after it.'''
+        with self.db.batch(self.conf.db_batch_rows, self.conf.db_batch_ms):
+            try:
+                self.scheduler.run()
+                if self.writer is not None and self.opts.action != OptAction.VERIFY:  # noqa: E501
+                    self.writer.submit(self.store.remove_unused)
+                    if self.dir_cache is not None:
+                        # Directories removed or excluded since last run.
+                        dirs = self.dir_cache.pop_unused(
+                            [i.name for i in self.conf.progs])
+                        if dirs:
+                            self.writer.submit(self.db.remove_dirs, dirs)
+            finally:
+                if shutdown and self.pool is not None:
+                    self.pool.shutdown()
+                if self.writer is not None:
+                    self.writer.close()
+                    self.writer = None
+                    self.store = None
+                self.scheduler = Scheduler(self._jobs)
@@ -0,0 +1,268 @@
+try:
+    from game_backuper._fastcdc import find_cut as _find_cut
+    have_fastcdc = True
+except ImportError:
+    have_fastcdc = False
+from array import array
+from base64 import b85encode
+from collections import namedtuple
+from hashlib import blake2b
+from os import close, remove, replace
+from os.path import dirname, exists, join
+from tempfile import mkstemp
+from threading import Event, Lock
+from typing import BinaryIO, List, Tuple
+from game_backuper.compress import (
+    CompressConfig,
+    CompressMethod,
+    compress_data,
+    decompress_data,
+)
+from game_backuper.enc import EncFile, EncFormat
+from game_backuper.file import hydrate_file_if_needed, mkdir_for_file
+from game_backuper.hashl import HashReader
+
+
+MIN_SIZE = 16384
+AVG_SIZE = 65536
+MAX_SIZE = 262144
+READ_SIZE = 4194304
+_MASK64 = 0xFFFFFFFFFFFFFFFF
+# Normalized chunking: harder to cut before AVG_SIZE, easier after it.
+# High bits are used because they depend on the last 64 bytes.
+MASK_S = ((1 << 18) - 1) << 46
+MASK_L = ((1 << 14) - 1) << 50
+
+
+def _gear_table() -> array:
+    # splitmix64 with a fixed seed. Must never change, otherwise chunk
+    # boundaries of all stored files change.
+    r = array('Q')
+    x = 0x6761_6d65_2d62_6b70
+    for _ in range(256):
+        x = (x + 0x9E3779B97F4A7C15) & _MASK64
+        z = x
+        z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+        z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _MASK64
+        r.append(z ^ (z >> 31))
+    return r
+
+
+GEAR = _gear_table()
+_GEAR = GEAR.tolist()
+
+
+def find_cut(data: bytes, start: int, end: int) -> int:
+    '''Return the length of the chunk starting at start. (FastCDC)'''
+    if have_fastcdc:
+        return _find_cut(data, start, end, GEAR, MIN_SIZE, AVG_SIZE,
+                         MAX_SIZE, MASK_S, MASK_L)
+    n = end - start
+    if n <= MIN_SIZE:
+        return n
+    if n > MAX_SIZE:
+        n = MAX_SIZE
+    normal = min(AVG_SIZE, n)
+    fp = 0
+    i = MIN_SIZE
+    while i < normal:
+        fp = ((fp << 1) + _GEAR[data[start + i]]) & _MASK64
+        if not fp & MASK_S:
+            return i + 1
+        i += 1
+    while i < n:
+        fp = ((fp << 1) + _GEAR[data[start + i]]) & _MASK64
+        if not fp & MASK_L:
+            return i + 1
+        i += 1
+    return n
+
+
+def iter_chunks(f: BinaryIO):
+    buf = b''
+    pos = 0
+    eof = False
+    while True:
+        if not eof and len(buf) - pos < MAX_SIZE:
+            d = f.read(READ_SIZE)
+            if d:
+                buf = buf[pos:] + d
+                pos = 0
+                continue
+            eof = True
+        if pos >= len(buf):
+            break
+        n = find_cut(buf, pos, len(buf))
+        yield buf[pos:pos + n]
+        pos += n
+
+
+def chunk_hash(data: bytes) -> str:
+    return blake2b(data, digest_size=32).hexdigest()
+
+
+def chunk_key(h: str, c: CompressConfig, encrypt: bool) -> str:
+    '''Return the key of chunk h stored with compression c and encrypt.
+    Chunks are only shared by files stored in the same way, so an encrypted
+    file never uses a plain chunk. Plain chunks are keyed by h alone, like
+    chunks stored by old versions.'''
+    if c is None and not encrypt:
+        return h
+    return f"{h}.{'e' if encrypt else 'p'}{c.method.value if c else ''}"
+
+
+def hash_of(key: str) -> str:
+    '''Return the hash of the data of chunk key.'''
+    return key.split('.', 1)[0]
+
+
+_Chunk = namedtuple('Chunk', ['hash', 'size', 'stored_size', 'x_compress_type', 'key', 'iv', 'crc32', 'enc_format'], defaults=(None,))  # noqa: E501
+
+
+class Chunk(_Chunk):
+    '''hash is the key of the chunk. See chunk_key.'''
+    @property
+    def encrypted(self):
+        return bool(self.key and self.iv and self.crc32)
+
+    @property
+    def compressed(self):
+        return self.x_compress_type is not None
+
+    @property
+    def compressed_type(self):
+        return CompressMethod(self.x_compress_type) if self.compressed else None  # noqa: E501
+
+
+class ChunkStore:
+    '''Content addressed store of file chunks in dest/.chunks.
+    Chunks are shared by all files and programs.'''
+    def __init__(self, dest: str, db, writer=None):
+        self._base = join(dest, '.chunks')
+        self._db = db
+        self._writer = writer
+        self._lock = Lock()
+        self._known = None
+        # hash -> Event set once the chunk is written or failed to write
+        self._writing = {}
+
+    def __claim(self, h: str) -> bool:
+        '''Return True if chunk h should be written by the caller. If it is
+        being written by another thread, wait until that is done.'''
+        while True:
+            with self._lock:
+                if self._known is None:
+                    self._known = self._db.get_chunk_hashes()
+                e = self._writing.get(h)
+                if e is None:
+                    if h in self._known and exists(self.chunk_path(h)):
+                        return False
+                    self._known.add(h)
+                    self._writing[h] = Event()
+                    return True
+            e.wait()
+
+    def __release(self, h: str, ok: bool):
+        with self._lock:
+            if not ok:
+                self._known.discard(h)
+            self._writing.pop(h).set()
+
+    def __write_chunk(self, h: str, data: bytes, c: CompressConfig,
+                      encrypt: bool) -> Chunk:
+        p = self.chunk_path(h)
+        mkdir_for_file(p)
+        fd, tmp = mkstemp('.tmp', h, dirname(p))
+        close(fd)
+        try:
+            ch = self.__write_tmp(tmp, h, data, c, encrypt)
+            replace(tmp, p)
+        except Exception:
+            if exists(tmp):
+                remove(tmp)
+            raise
+        return ch
+
+    def __write_tmp(self, tmp: str, h: str, data: bytes, c: CompressConfig,
+                    encrypt: bool) -> Chunk:
+        ct = c.method.value if c else None
+        if encrypt:
+            with EncFile(tmp, 'wb', bytes.fromhex(hash_of(h)), compress=c,
+                         format=EncFormat.GCM) as t:
+                t.write(data)
+            ch = Chunk(h, len(data), t.tell() if c else None, ct,
+                       b85encode(t.key).decode(), b85encode(t.iv).decode(),
+                       t.crc32, t.format.value)
+        else:
+            with open(tmp, 'wb') as t:
+                if c:
+                    compress_data(c, data, t)
+                else:
+                    t.write(data)
+            ch = Chunk(h, len(data), None, ct, None, None, None)
+        return ch
+
+    def chunk_path(self, h: str) -> str:
+        return join(self._base, h[:2], h)
+
+    def read_chunk(self, ch: Chunk) -> bytes:
+        p = self.chunk_path(ch.hash)
+        hydrate_file_if_needed(p)
+        c = CompressConfig(ch.compressed_type.to_str()) if ch.compressed else None  # noqa: E501
+        h = hash_of(ch.hash)
+        if ch.encrypted:
+            with EncFile(p, 'rb', bytes.fromhex(h), ch.key, ch.iv,
+                         ch.stored_size if ch.stored_size else ch.size,
+                         ch.crc32, c, ch.enc_format) as s:
+                d = s.read()
+        else:
+            with open(p, 'rb') as s:
+                d = decompress_data(c, s) if c else s.read()
+        if len(d) != ch.size or chunk_hash(d) != h:
+            raise ValueError(f'Chunk {ch.hash} is corrupted.')
+        return d
+
+    def remove_unused(self):
+        '''Remove chunks which are not used by any file.'''
+        hashes = self._db.remove_unused_chunks()
+        # Rows must be deleted before files, otherwise a crash leaves rows
+        # of removed chunks.
+        self._db.checkpoint(True)
+        for h in hashes:
+            p = self.chunk_path(h)
+            if exists(p):
+                remove(p)
+            with self._lock:
+                if self._known is not None:
+                    self._known.discard(h)
+
+    def restore_file(self, chunks: List[Chunk], dest: str) -> bool:
+        '''Write chunks to dest. Return False if some chunks are missing.'''
+        for ch in chunks:
+            if ch.size is None or not exists(self.chunk_path(ch.hash)):
+                return False
+        mkdir_for_file(dest)
+        with open(dest, 'wb') as t:
+            for ch in chunks:
+                t.write(self.read_chunk(ch))
+        return True
+
+    def store_file(self, src: str, c: CompressConfig, encrypt: bool,
+                   algorithm: str = None) -> Tuple[str, List[str]]:
+        '''Split src into chunks and store new chunks.
+        Return the hash of src computed with algorithm and keys of all
+        chunks.'''
+        hl = []
+        with HashReader(open(src, 'rb'), algorithm) as s:
+            for d in iter_chunks(s):
+                h = chunk_key(chunk_hash(d), c, encrypt)
+                hl.append(h)
+                if self.__claim(h):
+                    try:
+                        ch = self.__write_chunk(h, d, c, encrypt)
+                    except Exception:
+                        self.__release(h, False)
+                        raise
+                    self._writer.submit(self._db.add_chunk, ch)
+                    self.__release(h, True)
+        return s.hash, hl
@@ -9,6 +9,19 @@ else:
     DEFAULT_CONFIG = '/etc/game-backuper.yaml'
 
 
+def parse_size(s: str) -> int:
+    '''Parse size like 100, 10K, 1.5M or 2G. Return None if invalid.'''
+    s = s.strip().upper()
+    m = 1
+    if s[-1:] in ('K', 'M', 'G'):
+        m = 1024 ** ('KMG'.index(s[-1]) + 1)
+        s = s[:-1]
+    try:
+        return int(float(s) * m)
+    except (ValueError, OverflowError):
+        return None
+
+
 @unique
 class OptAction(IntEnum):
     BACKUP = 0
@@ -16,6 +29,8 @@ class OptAction(IntEnum):
     LIST = 2
     LIST_LEVELDB_KEY = 3
     VERSION = 4
+    WATCH = 5
+    VERIFY = 6
 
     @staticmethod
     def from_str(v: str) -> IntEnum:
@@ -31,6 +46,10 @@ class OptAction(IntEnum):
                 return OptAction.LIST_LEVELDB_KEY
             elif t == "version":
                 return OptAction.VERSION
+            elif t == 'watch':
+                return OptAction.WATCH
+            elif t == 'verify':
+                return OptAction.VERIFY
         else:
             raise TypeError('Must be str.')
 
@@ -41,11 +60,20 @@ class Opts:
     programs_list = None
     optimize_db = False
     change_key = False
+    paranoid = False
+    jobs = None
+    processes = None
+    rescan = False
+    sample = None
+    rate_limit = None
+    restart = False
 
     def __init__(self, cml: List[str]):
         try:
-            r = getopt(cml, 'hc:', ['help', 'config=', 'optimize-db',
-                                    'change-key'])
+            r = getopt(cml, 'hc:j:', ['help', 'config=', 'optimize-db',
+                                      'change-key', 'paranoid', 'jobs=',
+                                      'processes=', 'rescan', 'sample=',
+                                      'rate-limit=', 'restart'])
             for i in r[0]:
                 if i[0] == '-h' or i[0] == '--help':
                     self.print_help()
@@ -57,6 +85,33 @@ class Opts:
                     self.optimize_db = True
                 elif i[0] == '--change-key':
                     self.change_key = True
+                elif i[0] == '--paranoid':
+                    self.paranoid = True
+                elif i[0] == '--rescan':
+                    self.rescan = True
+                elif i[0] == '--restart':
+                    self.restart = True
+                elif i[0] == '--sample':
+                    try:
+                        v = float(i[1])
+                    except ValueError:
+                        v = 0
+                    if not 0 < v <= 1:
+                        raise GetoptError('sample should be a number in (0, 1].')  # noqa: E501
+                    self.sample = v
+                elif i[0] == '--rate-limit':
+                    v = parse_size(i[1])
+                    if v is None or v < 1:
+                        raise GetoptError('rate-limit should be a positive size.')  # noqa: E501
+                    self.rate_limit = v
+                elif i[0] == '-j' or i[0] == '--jobs':
+                    if not i[1].isdigit() or int(i[1]) < 1:
+                        raise GetoptError('jobs should be a positive integer.')  # noqa: E501
+                    self.jobs = int(i[1])
+                elif i[0] == '--processes':
+                    if not i[1].isdigit():
+                        raise GetoptError('processes should be a non-negative integer.')  # noqa: E501
+                    self.processes = int(i[1])
             if len(r[1]) > 0:
                 cm = r[1]
                 re = OptAction.from_str(cm[0])
@@ -80,11 +135,27 @@ class Opts:
 
     def print_help(self):
         print('''game-backuper [options] [backup|restore] [<game names> [...]]
+game-backuper [options] watch [<game names> [...]]
+                        Back up changed files continuously.
+game-backuper [options] verify [<game names> [...]]
+                        Check backup files against the database.
 game-backuper [options] list
 game-backuper [options] list_leveldb_key [<db_path> [...]]
 game-backuper version   Print library support message.
 Options:
     -h, --help          Print help message.
     -c, --config <path> Set config file.
+    -j, --jobs <n>      Number of files processed at the same time.
+    --processes <n>     Run compression and encryption in <n> processes.
+                        0 means run them in threads.
     --optimize-db       Optimize the sqlite3 database
-    --change-key        Change encrypt password''')
+    --change-key        Change encrypt password
+    --paranoid          Always rehash files even if their size, mtime,
+                        inode and ctime are unchanged
+    --rescan            List all directories even if their mtime are
+                        unchanged
+    --sample <fraction> Only verify a random fraction of files. (0, 1]
+    --rate-limit <size> Verify at most <size> bytes per second. Suffix K, M
+                        and G are supported.
+    --restart           Verify all files again instead of resuming last
+                        unfinished verify''')
@@ -60,6 +60,7 @@ except ImportError:
 from os.path import exists, isfile, getsize
 from os import remove
 from game_backuper.file import mkdir_for_file, hydrate_file_if_needed
+from game_backuper.hashl import HashReader
 
 
 if have_gzip:
@@ -355,7 +356,31 @@ def compress_info(ori: int, re: int):
     return f"{sizeof_fmt(ori)} -> {sizeof_fmt(re)} ({re/ori*100:.2f}%)"
 
 
-def compress(src: str, dest: str, c: CompressConfig, name: str, prog: str):
+def compress_data(c: CompressConfig, data: bytes, fp):
+    '''Compress data and write it to fp.'''
+    o = c.compressor(fp)
+    if hasattr(o, 'write_to_file'):
+        o.compress(data)
+        o.close()
+    else:
+        fp.write(o.compress(data))
+        fp.write(o.flush())
+
+
+def decompress_data(c: CompressConfig, fp) -> bytes:
+    '''Read all data from fp and decompress it.'''
+    o = c.decompressor(fp)
+    if hasattr(o, 'write_to_file'):
+        d = o.read(-1)
+        o.close()
+        return d
+    return o.decompress(fp.read())
+
+
+def compress(src: str, dest: str, c: CompressConfig, name: str, prog: str,
+             hash: bool = False, algorithm: str = None):
+    '''If hash is True, return the hash of src computed with algorithm while
+    compressing.'''
     exts = [''] + supported_exts.copy()
     exts.remove(c.ext)
     fn = dest + c.ext
@@ -363,8 +388,11 @@ def compress(src: str, dest: str, c: CompressConfig, name: str, prog: str):
     if exists(fn):
         remove(fn)
     mkdir_for_file(fn)
+    sr = open(src, 'rb')
+    if hash:
+        sr = HashReader(sr, algorithm)
     if c.method == CompressMethod.BZIP2:
-        with open(src, 'rb') as t:
+        with sr as t:
             with BZ2File(fn, 'wb', compresslevel=c.level) as f:
                 a = t.read(cs)
                 while a != b'':
@@ -372,7 +400,7 @@ def compress(src: str, dest: str, c: CompressConfig, name: str, prog: str):
                     a = t.read(cs)
                 del a
     elif c.method == CompressMethod.GZIP:
-        with open(src, 'rb') as t:
+        with sr as t:
             with GzipFile(fn, 'wb', compresslevel=c.level) as f:
                 a = t.read(cs)
                 while a != b'':
@@ -380,7 +408,7 @@ def compress(src: str, dest: str, c: CompressConfig, name: str, prog: str):
                     a = t.read(cs)
                 del a
     elif c.method == CompressMethod.LZMA:
-        with open(src, 'rb') as t:
+        with sr as t:
             with LZMAFile(fn, 'wb', preset=c.level) as f:
                 a = t.read(cs)
                 while a != b'':
@@ -388,7 +416,7 @@ def compress(src: str, dest: str, c: CompressConfig, name: str, prog: str):
                     a = t.read(cs)
                 del a
     elif c.method == CompressMethod.LZIP:
-        with open(src, 'rb') as t:
+        with sr as t:
             with LZIPFileEncoder(fn, c.level) as f:
                 a = t.read(cs)
                 while a != b'':
@@ -396,7 +424,7 @@ def compress(src: str, dest: str, c: CompressConfig, name: str, prog: str):
                     a = t.read(cs)
                 del a
     elif c.method == CompressMethod.ZSTD:
-        with open(src, 'rb') as t:
+        with sr as t:
             with ZSTDFile(fn, 'wb', compresslevel=c.level) as f:
                 a = t.read(cs)
                 while a != b'':
@@ -404,7 +432,7 @@ def compress(src: str, dest: str, c: CompressConfig, name: str, prog: str):
                     a = t.read(cs)
                 del a
     elif c.method == CompressMethod.SNAPPY:
-        with open(src, 'rb') as t:
+        with sr as t:
             with open(fn, 'wb') as f:
                 o = Snappy_Compressor()
                 a = t.read(cs)
@@ -417,7 +445,7 @@ def compress(src: str, dest: str, c: CompressConfig, name: str, prog: str):
         k = {}
         if c.level is not None:
             k['quality'] = c.level
-        with open(src, 'rb') as t:
+        with sr as t:
             with open(fn, 'wb') as f:
                 o = BrotliCompressor(**k)
                 a = t.read(cs)
@@ -436,74 +464,65 @@ def compress(src: str, dest: str, c: CompressConfig, name: str, prog: str):
         if exists(f) and isfile(f):
             remove(f)
             print(f'{prog}: Removed {f}({name})')
+    if hash:
+        return sr.hash
 
 
-def decompress(src: str, dest: str, c: CompressConfig, name: str, prog: str):
-    fn = src + c.ext
-    if exists(dest):
-        remove(dest)
+def iter_decompressed(fn: str, c: CompressConfig):
+    '''Yield decompressed data of fn in blocks.'''
     cs = c.chunk_size
-    hydrate_file_if_needed(fn)
     if c.method == CompressMethod.BZIP2:
         with BZ2File(fn, 'rb') as f:
-            with open(dest, 'wb') as t:
+            a = f.read(cs)
+            while a != b'':
+                yield a
                 a = f.read(cs)
-                while a != b'':
-                    t.write(a)
-                    a = f.read(cs)
-                del a
     elif c.method == CompressMethod.GZIP:
         with GzipFile(fn, 'rb') as f:
-            with open(dest, 'wb') as t:
+            a = f.read(cs)
+            while a != b'':
+                yield a
                 a = f.read(cs)
-                while a != b'':
-                    t.write(a)
-                    a = f.read(cs)
-                del a
     elif c.method == CompressMethod.LZMA:
         with LZMAFile(fn, 'rb') as f:
-            with open(dest, 'wb') as t:
+            a = f.read(cs)
+            while a != b'':
+                yield a
                 a = f.read(cs)
-                while a != b'':
-                    t.write(a)
-                    a = f.read(cs)
-                del a
     elif c.method == CompressMethod.LZIP:
-        with open(dest, 'wb') as t:
-            f = LZIP_decompress_file_iter(fn, chunk_size=cs)
-            for a in f:
-                t.write(a)
-            del a
+        yield from LZIP_decompress_file_iter(fn, chunk_size=cs)
     elif c.method == CompressMethod.ZSTD:
         with ZSTDFile(fn, 'rb') as f:
-            with open(dest, 'wb') as t:
+            a = f.read(cs)
+            while a != b'':
+                yield a
                 a = f.read(cs)
-                while a != b'':
-                    t.write(a)
-                    a = f.read(cs)
-                del a
     elif c.method == CompressMethod.SNAPPY:
         with open(fn, 'rb') as f:
-            with open(dest, 'wb') as t:
-                o = Snappy_Decompressor()
+            o = Snappy_Decompressor()
+            a = f.read(cs)
+            while a != b'':
+                yield o.decompress(a)
                 a = f.read(cs)
-                while a != b'':
-                    b = o.decompress(a)
-                    t.write(b)
-                    a = f.read(cs)
-                o.flush()
-                del a, b, o
+            o.flush()
     elif c.method == CompressMethod.BROTLI:
         with open(fn, 'rb') as f:
-            with open(dest, 'wb') as t:
-                o = BrotliDecompressor()
+            o = BrotliDecompressor()
+            a = f.read(cs)
+            while a != b'':
+                yield o.process(a)
                 a = f.read(cs)
-                while a != b'':
-                    b = o.process(a)
-                    t.write(b)
-                    a = f.read(cs)
-                if not o.is_finished():
-                    raise ValueError('Read all datas from file but seems not finished.')  # noqa: E501
-                del a, b, o
+            if not o.is_finished():
+                raise ValueError('Read all datas from file but seems not finished.')  # noqa: E501
+
+
+def decompress(src: str, dest: str, c: CompressConfig, name: str, prog: str):
+    fn = src + c.ext
+    if exists(dest):
+        remove(dest)
+    hydrate_file_if_needed(fn)
+    with open(dest, 'wb') as t:
+        for a in iter_decompressed(fn, c):
+            t.write(a)
     i = compress_info(getsize(dest), getsize(fn))
     print(f'{prog}: Decompressed {fn}({name}) -> {dest} ({i})')
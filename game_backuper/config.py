@@ -3,16 +3,19 @@ try:
     from yaml import CSafeLoader as SafeLoader
 except Exception:
     from yaml import SafeLoader
-from os.path import join, relpath, isfile, isdir, isabs, abspath
-from typing import List, Union
-from game_backuper.file import listdirs
+from os.path import join, relpath, isfile, isdir, isabs, abspath, normpath
+from os import curdir, sep
+from typing import Iterator, List, Union
+from game_backuper.file import DirCache, scan_files
 from collections import namedtuple
+from functools import partial
 try:
     from functools import cached_property
 except ImportError:
     cached_property = property
-from game_backuper.regexp import Regex, wildcards_to_regex
+from game_backuper.regexp import Regex, RegexSet, wildcards_to_regex
 from game_backuper.compress import CompressConfig
+from game_backuper.hashl import ALGORITHMS, DEFAULT_ALGORITHM
 
 
 class BasicOption:
@@ -24,6 +27,7 @@ class BasicOption:
     _disable_compress = False
     _protect_filename = None
     _unpin_file = None
+    _chunked = None
 
     @property
     def compress_config(self) -> CompressConfig:
@@ -41,6 +45,20 @@ class BasicOption:
                 return cfg._compress_config
         return None
 
+    @cached_property
+    def chunked(self) -> bool:
+        if self._chunked is not None:
+            return self._chunked
+        prog = getattr(self, "_prog", None)
+        if prog is not None:
+            if prog._chunked is not None:
+                return prog._chunked
+        cfg = getattr(self, "_cfg", None)
+        if cfg is not None:
+            if cfg._chunked is not None:
+                return cfg._chunked
+        return False
+
     @cached_property
     def enable_pcre2(self) -> bool:
         if self._enable_pcre2 is not None:
@@ -118,6 +136,18 @@ class BasicOption:
         self.parse_encrypt_files(data)
         self.parse_protect_filename(data)
         self.parse_unpin_file(data)
+        self.parse_chunked(data)
+
+    def parse_chunked(self, data=None):
+        if data is None:
+            data = getattr(self, 'data')
+        if 'chunked' in data:
+            v = data['chunked']
+            if isinstance(v, bool):
+                self._chunked = v
+            else:
+                raise TypeError('chunked option must be a boolean.')
+            del v
 
     def parse_compress_config(self, data=None):
         if data is None:
@@ -276,6 +306,38 @@ def parse_ex_or_in_cludes(li: list, enable_pcre2) -> List[Union[str, Regex]]:
     return r
 
 
+class RuleMatcher:
+    '''Include or exclude rules compiled for base directory b. Literal paths
+    are looked up in sets and all regexes are matched at once.'''
+    def __init__(self, rules: List[Union[str, Regex]], b: str):
+        self._b = b
+        self._prefix = join(abspath(b), '')
+        self._abs = set()
+        self._rel = set()
+        li = []
+        for i in rules:
+            if isinstance(i, str):
+                if isabs(i):
+                    self._abs.add(abspath(i))
+                else:
+                    self._rel.add(relpath(join(b, i), b))
+            elif isinstance(i, Regex):
+                li.append(i)
+        self._re = RegexSet(li) if li else None
+
+    def match(self, loc: str) -> bool:
+        bl = abspath(loc if isabs(loc) else join(self._b, loc))
+        if bl.startswith(self._prefix):
+            rl = bl[len(self._prefix):]
+        else:
+            rl = relpath(bl, self._b)
+        if bl in self._abs or rl in self._rel:
+            return True
+        if self._re is None:
+            return False
+        return self._re.match_only(rl) or (bl != loc and self._re.match_only(bl))  # noqa: E501
+
+
 class ConfigPath(BasicOption, NFBasicOption, BasicConfig):
     def __init__(self, data, cfg, prog):
         NFBasicOption.__init__(self, cfg, prog)
@@ -287,55 +349,30 @@ class ConfigPath(BasicOption, NFBasicOption, BasicConfig):
             raise TypeError('Must be str or dict.')
         self.parse_all()
         self.parse_all_nf()
+        self._matchers = {}
 
-    @property
+    @cached_property
     def excludes(self) -> List[Union[str, Regex]]:
-        t = getattr(self, "__excludes", None)
-        if t is not None:
-            return t
-        del t
         if 'excludes' in self.data:
             if isinstance(self.data['excludes'], list):
-                r = parse_ex_or_in_cludes(self.data["excludes"], self.enable_pcre2)  # noqa: E501
-                self.__excludes = r
-                return r
+                return parse_ex_or_in_cludes(self.data["excludes"], self.enable_pcre2)  # noqa: E501
 
-    @property
+    @cached_property
     def includes(self) -> List[Union[str, Regex]]:
-        t = getattr(self, "__includes", None)
-        if t is not None:
-            return t
-        del t
         if 'includes' in self.data:
             if isinstance(self.data['includes'], list):
-                r = parse_ex_or_in_cludes(self.data["includes"], self.enable_pcre2)  # noqa: E501
-                self.__includes = r
-                return r
+                return parse_ex_or_in_cludes(self.data["includes"], self.enable_pcre2)  # noqa: E501
 
     def is_ex_or_in_clude(self, b: str, loc: str, exclude: bool) -> bool:
         e = self.excludes if exclude else self.includes
         if e is None:
             return False if exclude else True
-        if isabs(loc):
-            bl = abspath(loc)
-            rl = relpath(loc, b)
-        else:
-            bl = abspath(join(b, loc))
-            rl = relpath(join(b, loc), b)
-        for i in e:
-            if isinstance(i, str):
-                if isabs(i):
-                    if abspath(i) == bl:
-                        return True
-                else:
-                    if relpath(join(b, i), b) == rl:
-                        return True
-            elif isinstance(i, Regex):
-                if i.match_only(rl):
-                    return True
-                elif bl != loc and i.match_only(bl):
-                    return True
-        return False
+        k = (b, exclude)
+        m = self._matchers.get(k)
+        if m is None:
+            m = RuleMatcher(e, b)
+            self._matchers[k] = m
+        return m.match(loc)
 
     def is_exclude(self, b: str, loc: str) -> bool:
         return self.is_ex_or_in_clude(b, loc, True)
@@ -370,21 +407,67 @@ class ConfigOLeveldb(BasicOption, NFBasicOption, BasicConfig):
                     return dms
 
 
-def namedtuple_bo(typename, field_names):
-    a = namedtuple(typename, field_names)
+def namedtuple_bo(typename, field_names, defaults=None):
+    a = namedtuple(typename, field_names, defaults=defaults)
     return type(typename, (a, BasicOption), {})
 
 
-ConfigNormalFile = namedtuple_bo('ConfigNormalFile', ['name', 'full_path'])
+# stat is the stat_result taken while listing files. None if unknown.
+ConfigNormalFile = namedtuple_bo('ConfigNormalFile', ['name', 'full_path', 'stat'], (None,))  # noqa: E501
 ConfigLeveldb = namedtuple_bo('ConfigLeveldb', ['name', 'full_path', 'domains'])  # noqa: E501
 ConfigResult = Union[ConfigNormalFile, ConfigLeveldb]
 ConfigOriginResult = Union[ConfigPath, ConfigOLeveldb]
 
 
+def _split_name(name: str) -> List[str]:
+    name = normpath(name)
+    return [] if name == curdir else name.split(sep)
+
+
+class ConfigIndex:
+    '''Prefix trie of configs keyed by components of their backup names.
+    lookup() visits one node per component of name. Like the order of
+    files in the config, the first matched config is returned.'''
+    def __init__(self, configs: List[ConfigOriginResult]):
+        # node: [children, (index, ConfigPath), (index, ConfigOLeveldb)]
+        self._root = [{}, [], []]
+        for n, c in enumerate(configs):
+            node = self._root
+            for i in _split_name(c.real_name):
+                node = node[0].setdefault(i, [{}, [], []])
+            if isinstance(c, ConfigPath):
+                node[1].append((n, c))
+            elif isinstance(c, ConfigOLeveldb):
+                node[2].append((n, c))
+
+    def lookup(self, name: str) -> ConfigOriginResult:
+        parts = _split_name(name)
+        node = self._root
+        # (index, depth, config)
+        li = [(n, 0, c) for n, c in node[1]]
+        depth = 0
+        for i in parts:
+            node = node[0].get(i)
+            if node is None:
+                break
+            depth += 1
+            li.extend((n, depth, c) for n, c in node[1])
+        else:
+            li.extend((n, depth, c) for n, c in node[2])
+        li.sort(key=lambda x: x[0])
+        for _, d, c in li:
+            if isinstance(c, ConfigPath):
+                tmp = sep.join(parts[d:]) or curdir
+                if c.is_exclude(c.real_name, tmp):
+                    continue
+                if not c.is_include(c.real_name, tmp):
+                    continue
+            return c
+
+
 class Program(BasicOption, NFBasicOption):
     def __init__(self, data: dict, cfg):
         self.data = data
-        self._files = None
         self._cfg = cfg
         self.parse_all()
         self.parse_all_nf()
@@ -413,99 +496,54 @@ class Program(BasicOption, NFBasicOption):
     def check(self) -> bool:
         if self.name is None or self.base is None:
             return False
-        self.files
+        if not isinstance(self.data.get('files'), list):
+            raise ValueError('Files is needed and should be a list.')
+        self.all_configs
+        self.workers
         return True
 
-    def clear_cache(self):
-        self._files = None
-
     @property
     def files(self) -> List[ConfigResult]:
+        return list(self.iter_files())
+
+    @cached_property
+    def config_index(self) -> 'ConfigIndex':
+        return ConfigIndex(self.all_configs)
+
+    def get_config(self, name: str) -> ConfigOriginResult:
+        return self.config_index.lookup(name)
+
+    def iter_files(self, cache: DirCache = None) -> Iterator[ConfigResult]:
+        '''Yield all files lazily. Directories are listed while files are
+        being processed. cache is passed to scan_files.'''
         ke = 'files'
         if ke not in self.data or not isinstance(self.data[ke], list):
             raise ValueError('Files is needed and should be a list.')
-        if self._files is not None:
-            return self._files.copy()
-        r = []
-        self._files = r.copy()
+        b = self.base
         for i in self.all_configs:
-            b = self.base
+            p = i.path if isabs(i.path) else join(b, i.path)
+            name = i.real_name
             if isinstance(i, ConfigPath):
-                if isabs(i.path):
-                    bp = i.path
+                if isfile(p):
+                    r = [ConfigNormalFile(relpath(join(b, name), b), p)]
+                elif isdir(p):
+                    # An excluded directory is not listed at all.
+                    prune = partial(i.is_exclude, p) if i.excludes else None  # noqa: E501
+                    r = (ConfigNormalFile(relpath(join(b, join(name, relpath(ii, p))), b), ii, st)  # noqa: E501
+                         for ii, st in scan_files(p, i.ignore_hidden_files,
+                                                  cache, prune=prune)
+                         if not i.is_exclude(p, ii) and i.is_include(p, ii))
                 else:
-                    bp = join(b, i.path)
-                name = i.real_name
-                if isfile(bp):
-                    tname = relpath(join(b, name), b)
-                    tmp = ConfigNormalFile(tname, bp)
-                    del tname
-                    tmp.parse_all(i.data)
-                    r.append(tmp)
-                elif isdir(bp):
-                    top = NFBasicOption(self._cfg, self)
-                    top.parse_ignore_hidden_files(i.data)
-                    ll = listdirs(bp, top.ignore_hidden_files)
-                    del top
-                    for ii in ll:
-                        if i.is_exclude(bp, ii):
-                            continue
-                        if not i.is_include(bp, ii):
-                            continue
-                        tname = relpath(join(b, join(name, relpath(ii, bp))), b)  # noqa: E501
-                        tmp = ConfigNormalFile(tname, ii)
-                        del tname
-                        tmp.parse_all(i.data)
-                        r.append(tmp)
+                    continue
             elif isinstance(i, ConfigOLeveldb):
-                if isabs(i.path):
-                    p = i.path
-                else:
-                    p = join(b, i.path)
-                name = i.real_name
-                tname = relpath(join(b, name), b)
-                tmp = ConfigLeveldb(tname, p, i.domains)
-                del tname
+                r = [ConfigLeveldb(relpath(join(b, name), b), p, i.domains)]
+            else:
+                continue
+            for tmp in r:
                 tmp.parse_all(i.data)
-                r.append(tmp)
-        for i in r:
-            i._cfg = self._cfg
-            i._prog = self
-        return r
-
-    def get_config(self, name: str) -> ConfigOriginResult:
-        for i in self.data['files']:
-            if isinstance(i, str):
-                if not relpath(name, i).startswith('..'):
-                    return ConfigPath(i, self._cfg, self)
-            elif isinstance(i, dict):
-                t = i['type']
-                if t == 'path':
-                    if isabs(i['path']):
-                        n = i['name']
-                    else:
-                        n = i['path']
-                        if 'name' in i and isinstance(i['name'], str):
-                            if i['name'] != '':
-                                n = i['name']
-                    if not relpath(name, n).startswith('..'):
-                        r = ConfigPath(i, self._cfg, self)
-                        tmp = relpath(name, n)
-                        if r.is_exclude(n, tmp):
-                            continue
-                        if not r.is_include(n, tmp):
-                            continue
-                        return r
-                elif t == 'leveldb':
-                    if isabs(i['path']):
-                        n = i['name']
-                    else:
-                        n = i['path']
-                        if 'name' in i and isinstance(i['name'], str):
-                            if i['name'] != '':
-                                n = i['name']
-                    if relpath(n, name) == '.':
-                        return ConfigOLeveldb(i, self._cfg, self)
+                tmp._cfg = self._cfg
+                tmp._prog = self
+                yield tmp
 
     @cached_property
     def name(self) -> str:
@@ -514,6 +552,56 @@ class Program(BasicOption, NFBasicOption):
             if isinstance(v, str) and len(v) > 0:
                 return v
 
+    def resolve_file(self, path: str) -> ConfigResult:
+        '''Return the config result of path without listing directories.
+        path is not required to exist. Return None if path is not backed up.
+        Files in a leveldb directory resolve to the leveldb.'''
+        b = self.base
+        for i in self.all_configs:
+            p = i.path if isabs(i.path) else join(b, i.path)
+            try:
+                rp = relpath(path, p)
+            except ValueError:
+                continue
+            if rp.startswith('..'):
+                continue
+            name = i.real_name
+            if isinstance(i, ConfigPath):
+                if isdir(path):
+                    continue
+                if rp == '.':
+                    tname = relpath(join(b, name), b)
+                else:
+                    parts = rp.split(sep)
+                    if i.ignore_hidden_files:
+                        if any(t.startswith('.') for t in parts):
+                            continue
+                    if i.excludes and any(i.is_exclude(p, join(p, *parts[:n])) for n in range(1, len(parts))):  # noqa: E501
+                        continue
+                    if i.is_exclude(p, path):
+                        continue
+                    if not i.is_include(p, path):
+                        continue
+                    tname = relpath(join(b, join(name, rp)), b)
+                r = ConfigNormalFile(tname, path)
+            elif isinstance(i, ConfigOLeveldb):
+                r = ConfigLeveldb(relpath(join(b, name), b), p, i.domains)
+            else:
+                continue
+            r.parse_all(i.data)
+            r._cfg = self._cfg
+            r._prog = self
+            return r
+
+    @cached_property
+    def workers(self) -> int:
+        if 'workers' in self.data:
+            v = self.data['workers']
+            if not isinstance(v, int) or v < 1:
+                raise ValueError('workers should be a positive integer.')
+            return v
+        return self._cfg.workers
+
 
 class Config(BasicOption, NFBasicOption):
     dest = ''
@@ -522,6 +610,15 @@ class Config(BasicOption, NFBasicOption):
     db_path = None
     progs = []
     progs_name = []
+    workers = None
+    max_jobs = None
+    process_workers = None
+    db_batch_rows = 1000
+    db_batch_ms = 1000
+    leveldb_batch_size = 0
+    watch_debounce = 2
+    watch_rescan_interval = 600
+    hash_algorithm = DEFAULT_ALGORITHM
 
     def __init__(self, fn: str):
         with open(fn, 'r', encoding='UTF-8') as f:
@@ -547,6 +644,49 @@ class Config(BasicOption, NFBasicOption):
             if not isinstance(t['db_path'], str):
                 raise ValueError('db_path should be a string.')
             self.db_path = t['db_path']
+        if 'workers' in t:
+            if not isinstance(t['workers'], int) or t['workers'] < 1:
+                raise ValueError('workers should be a positive integer.')
+            self.workers = t['workers']
+        if 'max_jobs' in t:
+            if not isinstance(t['max_jobs'], int) or t['max_jobs'] < 1:
+                raise ValueError('max_jobs should be a positive integer.')
+            self.max_jobs = t['max_jobs']
+        if 'process_workers' in t:
+            v = t['process_workers']
+            if not isinstance(v, int) or v < 0:
+                raise ValueError('process_workers should be a non-negative integer.')  # noqa: E501
+            self.process_workers = v
+        if 'db_batch_rows' in t:
+            v = t['db_batch_rows']
+            if not isinstance(v, int) or v < 1:
+                raise ValueError('db_batch_rows should be a positive integer.')  # noqa: E501
+            self.db_batch_rows = v
+        if 'db_batch_ms' in t:
+            v = t['db_batch_ms']
+            if not isinstance(v, int) or v < 0:
+                raise ValueError('db_batch_ms should be a non-negative integer.')  # noqa: E501
+            self.db_batch_ms = v
+        if 'leveldb_batch_size' in t:
+            v = t['leveldb_batch_size']
+            if not isinstance(v, int) or v < 0:
+                raise ValueError('leveldb_batch_size should be a non-negative integer.')  # noqa: E501
+            self.leveldb_batch_size = v
+        if 'watch_debounce' in t:
+            v = t['watch_debounce']
+            if not isinstance(v, (int, float)) or v < 0:
+                raise ValueError('watch_debounce should be a non-negative number.')  # noqa: E501
+            self.watch_debounce = v
+        if 'watch_rescan_interval' in t:
+            v = t['watch_rescan_interval']
+            if not isinstance(v, (int, float)) or v <= 0:
+                raise ValueError('watch_rescan_interval should be a positive number.')  # noqa: E501
+            self.watch_rescan_interval = v
+        if 'hash_algorithm' in t:
+            v = t['hash_algorithm']
+            if v not in ALGORITHMS:
+                raise ValueError(f'hash_algorithm should be one of {", ".join(ALGORITHMS)}.')  # noqa: E501
+            self.hash_algorithm = v
         if 'programs' not in t:
             raise ValueError("No programs found.")
         self.parse_all(t)
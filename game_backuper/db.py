@@ -1,11 +1,18 @@
+from concurrent.futures import Future
+from contextlib import contextmanager
 from getpass import getpass as _getpass
 from os import close
-from os.path import join
+from os.path import abspath, join
+from queue import SimpleQueue
 from shutil import move
 from sqlite3 import connect, Connection, DatabaseError
 from tempfile import mkstemp
-from threading import Lock
-from typing import List, Union
+from threading import Lock, Thread, local
+from time import monotonic
+from typing import Dict, List, Set, Tuple, Union
+from urllib.request import pathname2url
+from weakref import finalize
+from game_backuper.chunk import Chunk
 from game_backuper.cml import Opts
 from game_backuper.config import Config
 from game_backuper.enc import EncryptStats
@@ -27,8 +34,21 @@ file TEXT,
 size INT,
 program TEXT,
 hash TEXT,
+mtime INT,
+inode INT,
+ctime INT,
+type INT,
+key TEXT,
+iv TEXT,
+crc32 TEXT,
+compressed INT,
+compressed_size INT,
+enc_format INT,
 PRIMARY KEY(id)
 );'''
+FILES_INDEX = 'CREATE UNIQUE INDEX files_program_file ON files (program, file);'  # noqa: E501
+FILES_COLUMNS = 'id, file, size, program, hash, type, key, iv, crc32, compressed, compressed_size, mtime, inode, ctime, enc_format'  # noqa: E501
+# Only used to migrate old databases.
 FILETYPE_TABLE = '''CREATE TABLE filetype (
 id INT,
 type INT,
@@ -43,6 +63,68 @@ compressed INT,
 compressed_size INT,
 PRIMARY KEY(id)
 );'''
+CHUNKS_TABLE = '''CREATE TABLE chunks (
+hash TEXT,
+size INT,
+stored_size INT,
+compressed INT,
+key TEXT,
+iv TEXT,
+crc32 TEXT,
+enc_format INT,
+PRIMARY KEY(hash)
+);'''
+CHUNKS_COLUMNS = 'hash, size, stored_size, compressed, key, iv, crc32, enc_format'  # noqa: E501
+FILE_CHUNKS_TABLE = '''CREATE TABLE file_chunks (
+id INT,
+idx INT,
+hash TEXT,
+PRIMARY KEY(id, idx)
+);'''
+DIRS_TABLE = '''CREATE TABLE dirs (
+path TEXT,
+mtime INT,
+files TEXT,
+dirs TEXT,
+PRIMARY KEY(path)
+);'''
+# Files verified by an unfinished verify. Rows are removed once all files of
+# a program are verified.
+VERIFIED_TABLE = '''CREATE TABLE verified (
+id INT,
+hash TEXT,
+PRIMARY KEY(id)
+);'''
+
+
+# Number of pages copied per step when migrating the database.
+MIGRATE_PAGES = 4096
+
+
+def _print_progress(status: int, remaining: int, total: int):
+    print(f'Migrating database: {total - remaining}/{total} pages')
+
+
+def _join_names(li: List[str]) -> str:
+    # \0 can not be a part of file name.
+    return '\0'.join(li)
+
+
+def _split_names(s: str) -> List[str]:
+    return s.split('\0') if s else []
+
+
+class _Reader:
+    '''Read-only connection of a thread. Thread local data is released when
+    the thread exits, then the connection is closed by a finalizer.'''
+    def __init__(self, con: Connection):
+        self.con = con
+
+
+def _close_reader(readers: Set[Connection], lock: Lock, con: Connection):
+    with lock:
+        readers.discard(con)
+    con.close()
 
 
 def getpass(prompt, cfg: Config) -> str:
@@ -52,9 +134,13 @@ def getpass(prompt, cfg: Config) -> str:
 
 
 class Db:
-    VERSION = [1, 0, 0, 2]
+    VERSION = [1, 0, 0, 8]
     fn = None
 
+    def __batch_reset(self):
+        self._batch_changes = self.db.total_changes
+        self._batch_time = monotonic()
+
     def __check_database(self) -> bool:
         self.__updateExistsTable()
         v = self.__read_version()
@@ -65,27 +151,71 @@ class Db:
                 self.db.execute(FILETYPE_TABLE)
             if v < [1, 0, 0, 2]:
                 self.db.execute(ENCRYPTED_FILES_TABLE)
+            if v < [1, 0, 0, 3]:
+                self.db.execute('ALTER TABLE files ADD COLUMN mtime INT;')
+                self.db.execute('ALTER TABLE files ADD COLUMN inode INT;')
+                self.db.execute('ALTER TABLE files ADD COLUMN ctime INT;')
+            if v < [1, 0, 0, 4]:
+                self.db.execute(CHUNKS_TABLE)
+                self.db.execute(FILE_CHUNKS_TABLE)
+            if v < [1, 0, 0, 5]:
+                self.__fold_tables()
+            if v < [1, 0, 0, 6]:
+                self.db.execute(DIRS_TABLE)
+            if v < [1, 0, 0, 7]:
+                # NULL means EncFormat.CBC.
+                self.db.execute('ALTER TABLE files ADD COLUMN enc_format INT;')  # noqa: E501
+                if v >= [1, 0, 0, 4]:
+                    self.db.execute('ALTER TABLE chunks ADD COLUMN enc_format INT;')  # noqa: E501
+            if v < [1, 0, 0, 8]:
+                self.db.execute(VERIFIED_TABLE)
             self.__write_version()
         if v > self.VERSION:
             raise ValueError(
                 'Database version is higher. Please update program.')
         return True
 
+    def __commit(self):
+        # Inside batch(), commits are made by checkpoint() only.
+        if not self._batch_depth:
+            self.db.commit()
+
     def __create_table(self):
         if 'version' not in self._exist_table:
             self.db.execute(VERSION_TABLE)
             self.__write_version()
         if 'files' not in self._exist_table:
             self.db.execute(FILES_TABLE)
-        if 'filetype' not in self._exist_table:
-            self.db.execute(FILETYPE_TABLE)
-        if 'encrypted_files' not in self._exist_table:
-            self.db.execute(ENCRYPTED_FILES_TABLE)
+            self.db.execute(FILES_INDEX)
+        if 'chunks' not in self._exist_table:
+            self.db.execute(CHUNKS_TABLE)
+        if 'file_chunks' not in self._exist_table:
+            self.db.execute(FILE_CHUNKS_TABLE)
+        if 'dirs' not in self._exist_table:
+            self.db.execute(DIRS_TABLE)
+        if 'verified' not in self._exist_table:
+            self.db.execute(VERIFIED_TABLE)
         self.db.commit()
 
+    def __fold_tables(self):
+        '''Move filetype and encrypted_files into files and add an unique
+        index on (program, file).'''
+        for i in ['type INT', 'key TEXT', 'iv TEXT', 'crc32 TEXT',
+                  'compressed INT', 'compressed_size INT']:
+            self.db.execute(f'ALTER TABLE files ADD COLUMN {i};')
+        self.db.execute('UPDATE files SET type=(SELECT type FROM filetype WHERE filetype.id=files.id);')  # noqa: E501
+        self.db.execute('UPDATE files SET (key, iv, crc32, compressed, compressed_size)=(SELECT key, iv, crc32, compressed, compressed_size FROM encrypted_files WHERE encrypted_files.id=files.id);')  # noqa: E501
+        self.db.execute('DROP TABLE filetype;')
+        self.db.execute('DROP TABLE encrypted_files;')
+        # Old versions always used the first matched row.
+        self.db.execute('DELETE FROM files WHERE id NOT IN (SELECT MIN(id) FROM files GROUP BY program, file);')  # noqa: E501
+        self.db.execute(FILES_INDEX)
+
     def __init__(self, config: Config, opts: Opts):
         self._cfg = config
         self._opt = opts
+        self._key = None
+        self._encrypted = None
         self.fn = config.db_path if config.db_path else join(
             config.dest, "data.db")
         hydrate_file_if_needed(self.fn)
@@ -93,56 +223,63 @@ class Db:
         if config.encrypt_db:
             passpharse = getpass('Please input the password of the database:', config)  # noqa: E501
             if not self.encrypted:
-                tfn = mkstemp()
-                close(tfn[0])
-                tfn = tfn[1]
-                db = connect(tfn)
-                self.__set_encrypt_key(passpharse, db)
-                for q in self.db.iterdump():
-                    db.execute(q)
-                self.db.close()
-                db.close()
-                move(tfn, self.fn)
-                self.db = connect(self.fn, check_same_thread=False)
+                self.__migrate(passpharse)
             elif opts.change_key:
                 self.__set_encrypt_key(passpharse)
                 passpharse = getpass('Please input new password of the database:', config)  # noqa: E501
-                tfn = mkstemp()
-                close(tfn[0])
-                tfn = tfn[1]
-                db = connect(tfn)
-                self.__set_encrypt_key(passpharse, db)
-                for q in self.db.iterdump():
-                    db.execute(q)
-                self.db.close()
-                db.close()
-                move(tfn, self.fn)
-                self.db = connect(self.fn, check_same_thread=False)
+                self.__migrate(passpharse)
             self.__set_encrypt_key(passpharse)
+            self._key = passpharse
         else:
             if self.encrypted:
                 passpharse = getpass('Please input the password of the database:', config)  # noqa: E501
                 self.__set_encrypt_key(passpharse)
-                tfn = mkstemp()
-                close(tfn[0])
-                tfn = tfn[1]
-                db = connect(tfn)
-                for q in self.db.iterdump():
-                    db.execute(q)
-                self.db.close()
-                db.close()
-                move(tfn, self.fn)
-                self.db = connect(self.fn, check_same_thread=False)
+                self.__migrate(None)
         if opts.optimize_db:
             self.db.execute('VACUUM;')
             self.db.commit()
         ok = self.__check_database()
         if not ok:
             self.__create_table()
+        # Readers in other threads do not block the writer in WAL mode.
+        self.db.execute('PRAGMA journal_mode=WAL;')
+        self.db.execute('PRAGMA synchronous=NORMAL;')
         self._lock = Lock()
+        self._batch_depth = 0
+        self._holds = 0
+        self._local = local()
+        self._readers = set()
         if config.encrypt_db and not self.encrypted:
             print('Warning: Current library do not support encryption.')
 
+    def __migrate(self, key: str = None):
+        '''Copy the database to a new file encrypted with key (None means
+        not encrypted), then replace the database with it.'''
+        tfn = mkstemp()
+        close(tfn[0])
+        tfn = tfn[1]
+        if self.db.execute('PRAGMA cipher_version;').fetchone():
+            # SQLCipher can not use backup API between databases which have
+            # different keys.
+            print('Migrating database...')
+            self.db.execute('ATTACH DATABASE ? AS migrated KEY ?;',
+                            (tfn, key if key is not None else ''))
+            if key is not None:
+                self.db.execute('PRAGMA migrated.cipher_salt = "x\'2d506b1d2c3e7b075518f9db81039657\'";')  # noqa: E501
+            self.db.execute("SELECT sqlcipher_export('migrated');")
+            self.db.execute('DETACH DATABASE migrated;')
+        else:
+            db = connect(tfn)
+            if key is not None:
+                self.__set_encrypt_key(key, db)
+            self.db.backup(db, pages=MIGRATE_PAGES, progress=_print_progress)  # noqa: E501
+            db.close()
+        self.db.close()
+        move(tfn, self.fn)
+        self._encrypted = None
+        self.db = connect(self.fn, check_same_thread=False)
+        print('Migrated database.')
+
     def __read_version(self) -> List[int]:
         if 'version' not in self._exist_table:
             return None
@@ -150,6 +287,21 @@ class Db:
         for i in cur:
             return [k for k in i if isinstance(k, int)]
 
+    def __reader(self) -> Connection:
+        '''Return the read-only connection of current thread.'''
+        r = getattr(self._local, 'reader', None)
+        if r is None:
+            uri = f'file:{pathname2url(abspath(self.fn))}?mode=ro'
+            con = connect(uri, uri=True, check_same_thread=False)
+            if self._key is not None:
+                self.__set_encrypt_key(self._key, con)
+            r = _Reader(con)
+            self._local.reader = r
+            with self._lock:
+                self._readers.add(con)
+            finalize(r, _close_reader, self._readers, self._lock, con)
+        return r.con
+
     def __set_encrypt_key(self, key: str, db: Connection = None):
         if db is None:
             db = self.db
@@ -173,94 +325,302 @@ class Db:
                 tuple(self.VERSION))
         self.db.commit()
 
-    def add_file(self, f: File, commited: bool = True):
+    def add_chunk(self, ch: Chunk):
+        with self._lock:
+            self.db.execute(f'INSERT OR REPLACE INTO chunks ({CHUNKS_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?);', tuple(ch))  # noqa: E501
+            self.__commit()
+
+    def add_file(self, f: File, commited: bool = True) -> int:
+        '''Return the id of the new row.'''
         with self._lock:
-            self.db.execute('INSERT INTO files (file, size, program, hash) VALUES (?, ?, ?, ?);',  # noqa: E501
-                            (f.file, f.size, f.program, f.hash))
-            if f.type is not None:
-                cur = self.db.execute(
-                    'SELECT * FROM files WHERE program=? AND file=?;',
-                    (f.program, f.file))
-                for i in cur:
-                    self.db.execute('INSERT INTO filetype VALUES (?, ?);',
-                                    (i[0], f.type))
-            if f.encrypted:
-                cur = self.db.execute(
-                    'SELECT * FROM files WHERE program=? AND file=?;',
-                    (f.program, f.file))
-                for i in cur:
-                    self.db.execute('INSERT INTO encrypted_files VALUES (?, ?, ?, ?, ?, ?);', (i[0], f.key, f.iv, f.crc32, f.x_compress_type, f.compressed_size))  # noqa: E501
+            enc = f.encrypted
+            cur = self.db.execute(
+                f'INSERT INTO files ({FILES_COLUMNS}) VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);',  # noqa: E501
+                (f.file, f.size, f.program, f.hash, f.type,
+                 f.key if enc else None, f.iv if enc else None,
+                 f.crc32 if enc else None,
+                 f.x_compress_type if enc else None,
+                 f.compressed_size if enc else None,
+                 f.mtime, f.inode, f.ctime,
+                 f.enc_format if enc else None))
             if commited:
+                self.__commit()
+            return cur.lastrowid
+
+    @contextmanager
+    def batch(self, rows: int = 1000, ms: int = 1000):
+        '''Group mutations into a few transactions. Inside the block,
+        mutations are only committed by checkpoint() (once rows rows were
+        changed or ms milliseconds passed since last commit) and at the end
+        of the block. Blocks can be nested.'''
+        with self._lock:
+            if not self._batch_depth:
+                self._batch_rows = rows
+                self._batch_ms = ms
+                self.__batch_reset()
+            self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._batch_depth -= 1
+                if not self._batch_depth:
+                    self.db.commit()
+
+    def checkpoint(self, force: bool = False):
+        '''Commit pending mutations of current batch if the limits of
+        batch() are reached. Should be called when the database is in a
+        consistent state, e.g. after all mutations of a file were made.
+        Nothing is committed while the database is held.'''
+        with self._lock:
+            if not self._batch_depth or not self.db.in_transaction or self._holds:  # noqa: E501
+                return
+            if force or self.db.total_changes - self._batch_changes >= self._batch_rows or (monotonic() - self._batch_time) * 1000 >= self._batch_ms:  # noqa: E501
                 self.db.commit()
+                self.__batch_reset()
+
+    def clear_verified(self, prog: str):
+        with self._lock:
+            self.db.execute('DELETE FROM verified WHERE id IN (SELECT id FROM files WHERE program=?);', (prog,))  # noqa: E501
+            self.__commit()
+
+    def close(self):
+        with self._lock:
+            for con in self._readers:
+                con.close()
+            self._readers.clear()
+            self.db.close()
 
     @property
     def encrypted(self):
-        try:
+        if self._encrypted is None:
             con = connect(self.fn)
-            con.execute('SELECT count(*) FROM sqlite_master;')
-            con.close()
-            return False
-        except DatabaseError:
-            con.close()
-            return True
+            try:
+                con.execute('SELECT count(*) FROM sqlite_master;')
+                self._encrypted = False
+            except DatabaseError:
+                self._encrypted = True
+            finally:
+                con.close()
+        return self._encrypted
+
+    def get_dirs(self) -> Dict[str, Tuple[int, List[str], List[str]]]:
+        '''Return cached listings of directories. See DirCache.'''
+        cur = self.__reader().execute('SELECT path, mtime, files, dirs FROM dirs;')  # noqa: E501
+        return {i[0]: (i[1], _split_names(i[2]), _split_names(i[3])) for i in cur}  # noqa: E501
 
     def get_file(self, prog: str, file: str) -> File:
-        with self._lock:
-            cur = self.db.execute(
-                'SELECT files.*, filetype.type, encrypted_files.key, encrypted_files.iv, encrypted_files.crc32, encrypted_files.compressed, encrypted_files.compressed_size FROM files LEFT JOIN filetype ON files.id=filetype.id LEFT JOIN encrypted_files ON files.id=encrypted_files.id WHERE program=? AND file=?;',  # noqa: E501
-                (prog, file))
-            for i in cur:
-                return File(*i)
+        cur = self.__reader().execute(
+            f'SELECT {FILES_COLUMNS} FROM files WHERE program=? AND file=?;',  # noqa: E501
+            (prog, file))
+        for i in cur:
+            return File(*i)
+
+    def get_chunk_hashes(self) -> Set[str]:
+        cur = self.__reader().execute('SELECT hash FROM chunks;')
+        return set(i[0] for i in cur)
+
+    def get_file_chunks(self, id: int) -> List[Chunk]:
+        cur = self.__reader().execute('SELECT file_chunks.hash, chunks.size, chunks.stored_size, chunks.compressed, chunks.key, chunks.iv, chunks.crc32, chunks.enc_format FROM file_chunks LEFT JOIN chunks ON file_chunks.hash=chunks.hash WHERE file_chunks.id=? ORDER BY file_chunks.idx;', (id,))  # noqa: E501
+        return [Chunk(*i) for i in cur]
+
+    def get_file_ids(self) -> Set[int]:
+        cur = self.__reader().execute('SELECT id FROM files;')
+        return set(i[0] for i in cur)
 
     def get_file_list(self, prog: str) -> List[str]:
+        cur = self.__reader().execute(
+            'SELECT file FROM files WHERE program=?;', (prog,))
+        li = []
+        for i in cur:
+            li.append(i[0])
+        return li
+
+    def get_files_with_plain_chunks(self, prog: str) -> Set[int]:
+        '''Return ids of chunked files of prog which use unencrypted
+        chunks.'''
+        cur = self.__reader().execute('SELECT DISTINCT files.id FROM files JOIN file_chunks ON files.id=file_chunks.id JOIN chunks ON file_chunks.hash=chunks.hash WHERE files.program=? AND chunks.key IS NULL;', (prog,))  # noqa: E501
+        return set(i[0] for i in cur)
+
+    def get_verified(self, prog: str) -> Dict[int, str]:
+        '''Return {id: hash} of files of prog verified by last unfinished
+        verify.'''
+        cur = self.__reader().execute('SELECT verified.id, verified.hash FROM verified JOIN files ON verified.id=files.id WHERE files.program=?;', (prog,))  # noqa: E501
+        return {i[0]: i[1] for i in cur}
+
+    def hold(self):
+        '''Do not commit in checkpoint() until release() is called.'''
         with self._lock:
-            cur = self.db.execute('SELECT file FROM files WHERE program=?;',
-                                  (prog,))
-            li = []
-            for i in cur:
-                li.append(i[0])
-            return li
+            self._holds += 1
+
+    def load_program_index(self, prog: str) -> Dict[str, File]:
+        '''Return all files of prog keyed by file name.'''
+        cur = self.__reader().execute(
+            f'SELECT {FILES_COLUMNS} FROM files WHERE program=?;', (prog,))
+        return {i[1]: File(*i) for i in cur}
+
+    def release(self):
+        with self._lock:
+            self._holds -= 1
+
+    def remove_dirs(self, paths: List[str]):
+        with self._lock:
+            self.db.executemany('DELETE FROM dirs WHERE path=?;',
+                                ((i,) for i in paths))
+            self.__commit()
 
     def remove_file(self, id: Union[int, File]):
         with self._lock:
-            ft = None
-            if isinstance(id, File):
-                iid = id.id
-                ft = id.type
-            else:
-                cur = self.db.execute('SELECT type FROM filetype WHERE id=?;',
-                                      (id,))
-                for i in cur:
-                    ft = FileType(i[0])
-                iid = id
+            iid = id.id if isinstance(id, File) else id
             self.db.execute('DELETE FROM files WHERE id=?;', (iid,))
-            if ft is not None:
-                self.db.execute('DELETE FROM filetype WHERE id=?;', (iid,))
-            cur = self.db.execute('SELECT * FROM encrypted_files WHERE id=?;', (iid,))  # noqa: E501
-            for i in cur:
-                self.db.execute('DELETE FROM encrypted_files WHERE id=?;', (iid,))  # noqa: E501
-                break
-            self.db.commit()
+            self.db.execute('DELETE FROM file_chunks WHERE id=?;', (iid,))
+            self.db.execute('DELETE FROM verified WHERE id=?;', (iid,))
+            self.__commit()
 
-    def set_file(self, id: int, size: int, hash: str):
+    def remove_unused_chunks(self) -> List[str]:
+        '''Remove chunks which are not used by any file. Return their hashes'''
         with self._lock:
-            self.db.execute('UPDATE files SET size=?, hash=? WHERE id=?;',
-                            (size, hash, id))
-            self.db.commit()
+            cur = self.db.execute('SELECT hash FROM chunks WHERE hash NOT IN (SELECT hash FROM file_chunks);')  # noqa: E501
+            li = [i[0] for i in cur]
+            self.db.execute('DELETE FROM chunks WHERE hash NOT IN (SELECT hash FROM file_chunks);')  # noqa: E501
+            self.__commit()
+            return li
+
+    def set_dirs(self, dirs: Dict[str, Tuple[int, List[str], List[str]]]):
+        with self._lock:
+            self.db.executemany('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?);', ((k, v[0], _join_names(v[1]), _join_names(v[2])) for k, v in dirs.items()))  # noqa: E501
+            self.__commit()
+
+    def set_file(self, id: int, size: int, hash: str, mtime: int = None,
+                 inode: int = None, ctime: int = None):
+        with self._lock:
+            self.db.execute('UPDATE files SET size=?, hash=?, mtime=?, inode=?, ctime=? WHERE id=?;',  # noqa: E501
+                            (size, hash, mtime, inode, ctime, id))
+            self.__commit()
 
     def set_file_encrypt_information(self, id: int, stats: EncryptStats):
         if stats is not None and not isinstance(stats, EncryptStats):
             raise TypeError(f"Expected EncryptStats, got {type(stats)}")
         with self._lock:
             if stats is None:
-                self.db.execute('DELETE FROM encrypted_files WHERE id=?;', (id,))  # noqa: E501
+                self.db.execute('UPDATE files SET key=NULL, iv=NULL, crc32=NULL, compressed=NULL, compressed_size=NULL, enc_format=NULL WHERE id=?;', (id,))  # noqa: E501
             else:
-                cur = self.db.execute('SELECT * FROM encrypted_files WHERE id=?;', (id,))  # noqa: E501
-                have_data = False
-                for _ in cur:
-                    have_data = True
-                if have_data:
-                    self.db.execute('UPDATE encrypted_files SET key=?, iv=?, crc32=?, compressed=?, compressed_size=? WHERE id=?;', (stats.key, stats.iv, stats.crc32, stats.compress_type.value if stats.compressed else None, stats.compressed_size if stats.compressed else None, id))  # noqa: E501
-                else:
-                    self.db.execute('INSERT INTO encrypted_files VALUES (?, ?, ?, ?, ?, ?);', (id, stats.key, stats.iv, stats.crc32, stats.compress_type.value if stats.compressed else None, stats.compressed_size if stats.compressed else None))  # noqa: E501
-            self.db.commit()
+                self.db.execute('UPDATE files SET key=?, iv=?, crc32=?, compressed=?, compressed_size=?, enc_format=? WHERE id=?;', (stats.key, stats.iv, stats.crc32, stats.compress_type.value if stats.compressed else None, stats.compressed_size, stats.format, id))  # noqa: E501
+            self.__commit()
+
+    def set_file_hash(self, id: int, hash: str, key: str = None):
+        '''Replace the hash of a file and the key of it if encrypted, since
+        the key is salted with the hash.'''
+        with self._lock:
+            if key is None:
+                self.db.execute('UPDATE files SET hash=? WHERE id=?;', (hash, id))  # noqa: E501
+            else:
+                self.db.execute('UPDATE files SET hash=?, key=? WHERE id=?;', (hash, key, id))  # noqa: E501
+            self.__commit()
+
+    def set_file_chunks(self, id: int, hashes: List[str]):
+        with self._lock:
+            self.db.execute('DELETE FROM file_chunks WHERE id=?;', (id,))
+            self.db.executemany('INSERT INTO file_chunks VALUES (?, ?, ?);',
+                                ((id, i, h) for i, h in enumerate(hashes)))
+            self.__commit()
+
+    def set_file_type(self, id: int, type: FileType):
+        with self._lock:
+            self.db.execute('UPDATE files SET type=? WHERE id=?;',
+                            (type, id))
+            self.__commit()
+
+    def set_verified(self, id: int, hash: str):
+        with self._lock:
+            self.db.execute('INSERT OR REPLACE INTO verified VALUES (?, ?);', (id, hash))  # noqa: E501
+            self.__commit()
+
+
+class _GroupFuture(Future):
+    def __init__(self, writer):
+        Future.__init__(self)
+        self._writer = writer
+
+    def result(self, timeout=None):
+        self._writer.flush()
+        return Future.result(self, timeout)
+
+
+class DbWriter(Thread):
+    '''Run database mutations submitted by worker threads on one thread.
+    Mutations are applied in submission order.'''
+    def __init__(self, db: Db = None):
+        Thread.__init__(self, name="DbWriter", daemon=True)
+        self._queue = SimpleQueue()
+        self._exc = None
+        self._db = db
+        self._local = local()
+
+    def __call(self, fut: Future, func, args, kw):
+        if not fut.set_running_or_notify_cancel():
+            return
+        try:
+            fut.set_result(func(*args, **kw))
+        except BaseException as e:
+            if self._exc is None:
+                self._exc = e
+            fut.set_exception(e)
+
+    def __run_group(self, ops):
+        for t in ops:
+            self.__call(*t)
+
+    def close(self):
+        '''Wait for all submitted mutations. Raise the first error if any.'''
+        self._queue.put(None)
+        self.join()
+        if self._exc is not None:
+            raise self._exc
+
+    def flush(self):
+        '''Queue mutations grouped by current thread. The database is held
+        until the group ends, so the part queued now is not committed
+        alone.'''
+        ops = getattr(self._local, 'group', None)
+        if not ops:
+            return
+        self._local.group = []
+        if not self._local.held and self._db is not None:
+            self._local.held = True
+            ops.insert(0, (Future(), self._db.hold, (), {}))
+        self._queue.put((Future(), self.__run_group, (ops,), {}))
+
+    @contextmanager
+    def group(self):
+        '''Mutations submitted by current thread in the block are run as
+        one call at the end of the block, so checkpoint() called by other
+        threads can not commit a part of them.'''
+        self._local.group = []
+        self._local.held = False
+        try:
+            yield
+        finally:
+            ops = self._local.group
+            self._local.group = None
+            if self._local.held:
+                ops.append((Future(), self._db.release, (), {}))
+            if ops:
+                self._queue.put((Future(), self.__run_group, (ops,), {}))
+
+    def run(self):
+        while True:
+            t = self._queue.get()
+            if t is None:
+                break
+            self.__call(*t)
+
+    def submit(self, func, *args, **kw) -> Future:
+        ops = getattr(self._local, 'group', None)
+        if ops is not None:
+            fut = _GroupFuture(self)
+            ops.append((fut, func, args, kw))
+            return fut
+        fut = Future()
+        self._queue.put((fut, func, args, kw))
+        return fut
@@ -1,23 +1,77 @@
 from base64 import b85decode, b85encode
-from collections import namedtuple
-from io import RawIOBase
-from os import PathLike, remove, urandom
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from enum import IntEnum
+from io import RawIOBase, UnsupportedOperation
+from os import PathLike, cpu_count, fstat, remove, urandom
 from os.path import exists, getsize
+from threading import Lock
 from typing import Union
 from zlib import crc32
+from cryptography.exceptions import InvalidTag
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from game_backuper.compress import (
     CompressConfig,
     CompressMethod,
     compress_info,
 )
 from game_backuper.file import File, hydrate_file_if_needed, mkdir_for_file
+from game_backuper.hashl import HashReader, digest_of
 
 
 _MODE_CLOSED = 0
 _MODE_READ = 1
 _MODE_WRITE = 3
-_EncrpytStats = namedtuple('EncryptStats', ['key', 'iv', 'crc32', 'x_compress_type', 'compressed_size'])  # noqa: E501
+# Must be a multiple of AES block size.
+READ_BLOCK = 1048576
+# Size of plain data in a chunk of GCM format.
+GCM_CHUNK = 1048576
+GCM_TAG = 16
+_EncrpytStats = namedtuple('EncryptStats', ['key', 'iv', 'crc32', 'x_compress_type', 'compressed_size', 'format'], defaults=(None,))  # noqa: E501
+# Max number of GCM chunks being encrypted or decrypted per file.
+_AHEAD = (cpu_count() or 1) * 2
+_pool = None
+_pool_lock = Lock()
+
+
+class EncFormat(IntEnum):
+    # Whole file is encrypted with AES-CBC.
+    CBC = 1
+    # Data is split into GCM_CHUNK bytes chunks. Every chunk is encrypted
+    # and authenticated with AES-GCM. Nonce of a chunk is iv[:4] + index.
+    # Associated data is b'\x01' for the last chunk and b'\x00' for others,
+    # so a truncated file can not be decrypted. The last chunk may be empty.
+    GCM = 2
+
+
+def _get_pool() -> ThreadPoolExecutor:
+    '''Return the thread pool used to encrypt and decrypt GCM chunks.
+    Return None if only one CPU is available.'''
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            n = cpu_count() or 1
+            if n < 2:
+                return None
+            _pool = ThreadPoolExecutor(n, 'EncFile')
+        return _pool
+
+
+def _reset_pool():
+    '''Threads of the pool do not exist in a forked child, and the lock
+    may be held by one of them. Give the child its own pool.'''
+    global _pool, _pool_lock
+    _pool = None
+    _pool_lock = Lock()
+
+
+try:
+    from os import register_at_fork
+    register_at_fork(after_in_child=_reset_pool)
+except ImportError:
+    # fork is not available.
+    pass
 
 
 class EncryptStats(_EncrpytStats):
@@ -45,7 +99,9 @@ class EncFile(RawIOBase):
     def __init__(self, fn, mode: str, salt: Union[bytes, str],
                  key: Union[bytes, str] = None, iv: Union[bytes, str] = None,
                  length: int = None, crc32: Union[str, int] = None,
-                 compress: CompressConfig = None):
+                 compress: CompressConfig = None, format: int = None):
+        '''format is a EncFormat. None means CBC, which was the only format
+        before formats were recorded.'''
         self._fp = None
         self._mode = _MODE_CLOSED
         if mode in ["", "r", "rb"]:
@@ -68,8 +124,15 @@ class EncFile(RawIOBase):
         if self._mode == _MODE_WRITE:
             self._key = urandom(32)
             self._iv = urandom(16)
-            self._cipher = Cipher(algorithms.AES(self._key), modes.CBC(self._iv))  # noqa: E501
-            self._enc = self._cipher.encryptor()
+            self._format = EncFormat(format or EncFormat.CBC)
+            if self._format == EncFormat.GCM:
+                self._gcm = AESGCM(self._key)
+                self._index = 0
+                self._pending = bytearray()
+                self._inflight = deque()
+            else:
+                self._cipher = Cipher(algorithms.AES(self._key), modes.CBC(self._iv))  # noqa: E501
+                self._enc = self._cipher.encryptor()
             self._crc32 = 0
             if compress is not None:
                 self._compressor = compress.compressor(self)
@@ -77,10 +140,7 @@ class EncFile(RawIOBase):
                     raise NotImplementedError('Unsupported compression type.')
             else:
                 self._compressor = None
-        if isinstance(salt, str):
-            self._salt = b85decode(salt)
-        else:
-            self._salt = salt
+        self.set_salt(salt)
         if self._mode == _MODE_READ:
             if isinstance(key, str):
                 key = b85decode(key)
@@ -92,12 +152,26 @@ class EncFile(RawIOBase):
             if iv is None or len(iv) != 16:
                 raise ValueError('A 128-bit initialization_vector is required.')  # noqa: E501
             self._iv = iv
-            self._cipher = Cipher(algorithms.AES(self.key), modes.CBC(self._iv))  # noqa: E501
-            self._dec = self._cipher.decryptor()
+            self._format = EncFormat(format or EncFormat.CBC)
+            if self._format == EncFormat.GCM:
+                self._gcm = AESGCM(self.key)
+                self._index = 0
+                self._ahead = deque()
+                self._fsize = fstat(self._fp.fileno()).st_size
+                if self._fsize < GCM_TAG:
+                    raise DecryptException('File is truncated.')
+                self._out = b''
+            else:
+                self._cipher = Cipher(algorithms.AES(self.key), modes.CBC(self._iv))  # noqa: E501
+                self._dec = self._cipher.decryptor()
+                self._raw = bytearray(READ_BLOCK)
+                self._out = bytearray(READ_BLOCK + algorithms.AES.block_size)  # noqa: E501
             if length is None or not isinstance(length, int):
                 raise ValueError("data's length is needed.")
             self._length = length
-            self._buf = b''
+            # Decrypted data is self._out[self._start:self._end].
+            self._start = 0
+            self._end = 0
             self._eof = False
             if crc32:
                 if isinstance(crc32, str):
@@ -112,7 +186,7 @@ class EncFile(RawIOBase):
                 self._decompressor = compress.decompressor(self)
                 if self._decompressor is None:
                     raise NotImplementedError('Unsupported compression type.')
-                self._debuf = b''
+                self._debuf = bytearray()
         self._pos = 0
         self._crc_size = algorithms.AES.block_size * 8
         self._flushing = False
@@ -142,16 +216,22 @@ class EncFile(RawIOBase):
                         if self._pos < self._crc_size:
                             le = min(length, self._crc_size - self._pos)
                             self._crc32 = crc32(d[:le], self._crc32)
-                        self._fp.write(self._enc.update(d))
+                        self.__write(d)
                         self._pos += length
-                if self._pos % algorithms.AES.block_size != 0:
-                    self._fp.write(self._enc.update(b"\x00" * (algorithms.AES.block_size - (self._pos % algorithms.AES.block_size))))  # noqa: E501
-                self._fp.write(self._enc.finalize())
+                if self._format == EncFormat.GCM:
+                    self.__put_chunk(bytes(self._pending), True)
+                    while self._inflight:
+                        self._fp.write(self._inflight.popleft().result())
+                else:
+                    if self._pos % algorithms.AES.block_size != 0:
+                        self._fp.write(self._enc.update(b"\x00" * (algorithms.AES.block_size - (self._pos % algorithms.AES.block_size))))  # noqa: E501
+                    self._fp.write(self._enc.finalize())
         finally:
             self._fp.close()
             self._dec = None
             self._enc = None
             self._cipher = None
+            self._gcm = None
             self._fp = None
             self._mode = _MODE_CLOSED
 
@@ -159,36 +239,44 @@ class EncFile(RawIOBase):
     def closed(self):
         return self._mode == _MODE_CLOSED
 
+    def __check_crc32(self):
+        if self._crc32 is not None and not self._crc32_checked:
+            if not self.check_crc32():
+                raise DecryptException("crc32 check failed.")
+            self._crc32_checked = True
+
     def check_crc32(self):
-        while len(self._buf) < self._crc_size:
-            if not self.__read():
-                break
-        if crc32(self._buf[:min(self._crc_size, self._length)]) == self._crc32:
-            return True
-        else:
-            return False
+        # The first block is larger than crc size.
+        if self._start == self._end:
+            self.__read()
+        le = min(self._crc_size, self._length, self._end - self._start)
+        with memoryview(self._out) as v:
+            return crc32(v[self._start:self._start + le]) == self._crc32
 
     @property
     def crc32(self):
         return '{:08x}'.format(self._crc32)
 
     def __decompress(self):
-        if len(self._buf) == 0:
+        if self._start == self._end and not self.__read():
             return False
-        if self._decompressor:
-            le = min(len(self._buf), self._length - self._pos)
-            if le == 0 or (hasattr(self._decompressor, "eof") and self._decompressor.eof):  # noqa: E501
-                return False
-            self._debuf += self._decompressor.decompress(self._buf[:le])
-            self._pos += le
-            self._buf = self._buf[le:]
-            return True
-        return False
+        le = min(self._end - self._start, self._length - self._pos)
+        if le == 0 or (hasattr(self._decompressor, "eof") and self._decompressor.eof):  # noqa: E501
+            return False
+        d = bytes(self._out[self._start:self._start + le])
+        self._debuf += self._decompressor.decompress(d)
+        self._pos += le
+        self._start += le
+        return True
 
     @property
     def eof(self):
         return self._pos >= self._length
 
+    @property
+    def format(self) -> EncFormat:
+        return self._format
+
     def fileno(self):
         self._check_not_closed()
         return self._fp.fileno()
@@ -209,25 +297,89 @@ class EncFile(RawIOBase):
         self._check_not_closed()
         return self._mode == _MODE_READ
 
+    def __nonce(self, index: int) -> bytes:
+        return self._iv[:4] + index.to_bytes(8, 'big')
+
+    def __open_chunk(self, index: int, data: bytes, final: bool) -> bytes:
+        try:
+            return self._gcm.decrypt(self.__nonce(index), data, b'\x01' if final else b'\x00')  # noqa: E501
+        except InvalidTag:
+            raise DecryptException(f'Chunk {index} is corrupted.')
+
+    def __put_chunk(self, data: bytes, final: bool):
+        index = self._index
+        self._index += 1
+        pool = _get_pool()
+        if pool is None:
+            self._fp.write(self.__seal_chunk(index, data, final))
+            return
+        self._inflight.append(pool.submit(self.__seal_chunk, index, data, final))  # noqa: E501
+        while len(self._inflight) > _AHEAD:
+            self._fp.write(self._inflight.popleft().result())
+
     def __read(self):
-        data = self._fp.read(algorithms.AES.block_size)
-        if not data:
-            if not self._eof:
-                self._buf += self._dec.finalize()
+        '''Decrypt next block into self._out. Only called if all decrypted
+        data is consumed.'''
+        if self._format == EncFormat.GCM:
+            return self.__read_gcm()
+        while not self._eof:
+            n = self._fp.readinto(self._raw)
+            if n:
+                with memoryview(self._raw) as v:
+                    m = self._dec.update_into(v[:n], self._out)
+            else:
+                d = self._dec.finalize()
+                self._out[:len(d)] = d
+                m = len(d)
                 self._eof = True
+            if m:
+                self._start = 0
+                self._end = m
+                return True
+        return False
+
+    def __read_gcm(self):
+        pool = _get_pool()
+        while len(self._ahead) < (1 if pool is None else _AHEAD):
+            off = self._index * (GCM_CHUNK + GCM_TAG)
+            if off >= self._fsize:
+                break
+            n = min(GCM_CHUNK + GCM_TAG, self._fsize - off)
+            d = self._fp.read(n)
+            if len(d) < n:
+                raise DecryptException('File is truncated.')
+            final = off + n >= self._fsize
+            if pool is None:
+                self._ahead.append(self.__open_chunk(self._index, d, final))
             else:
-                return False
-        else:
-            self._buf += self._dec.update(data)
+                self._ahead.append(pool.submit(self.__open_chunk, self._index, d, final))  # noqa: E501
+            self._index += 1
+        if not self._ahead:
+            return False
+        d = self._ahead.popleft()
+        self._out = d if pool is None else d.result()
+        self._start = 0
+        self._end = len(self._out)
         return True
 
+    def __readinto(self, b) -> int:
+        with memoryview(b) as view, view.cast("B") as byte_view:
+            size = min(len(byte_view), self._length - self._pos)
+            n = 0
+            while n < size:
+                if self._start == self._end and not self.__read():
+                    break
+                le = min(size - n, self._end - self._start)
+                byte_view[n:n + le] = self._out[self._start:self._start + le]  # noqa: E501
+                self._start += le
+                n += le
+        self._pos += n
+        return n
+
     def read(self, size: int = -1):
         if not self.readable():
             raise ValueError('File is not readable.')
-        if self._crc32 is not None and not self._crc32_checked:
-            if not self.check_crc32():
-                raise DecryptException("crc32 check failed.")
-            self._crc32_checked = True
+        self.__check_crc32()
         if size < 0:
             return self.readall()
         if self._decompressor and hasattr(self._decompressor, 'write_to_file') and self._decompressor.write_to_file:  # noqa: E501
@@ -238,45 +390,64 @@ class EncFile(RawIOBase):
         if self._decompressor and not hasattr(self._decompressor, 'write_to_file'):  # noqa: E501
             if not size or (self.eof and len(self._debuf) == 0):
                 return b""
-            while True:
-                if not self.__read():
-                    self.__decompress()
-                    break
+            while len(self._debuf) < size:
                 if not self.__decompress():
                     break
-                if size <= len(self._debuf):
-                    data = self._debuf[:size]
-                    self._debuf = self._debuf[size:]
-                    return data
-            d = self._debuf[:size]
-            self._debuf = self._debuf[size:]
+            d = bytes(self._debuf[:size])
+            del self._debuf[:size]
             return d
         if not size or self.eof:
             return b""
         size = min(size, self._length - self._pos)
-        if size <= len(self._buf):
-            data = self._buf[:size]
-            self._buf = self._buf[size:]
+        if size <= self._end - self._start:
+            d = bytes(self._out[self._start:self._start + size])
+            self._start += size
             self._pos += size
-            return data
-        while True:
-            if not self.__read():
-                break
-            if size <= len(self._buf):
-                data = self._buf[:size]
-                self._buf = self._buf[size:]
-                self._pos += size
-                return data
-        self._pos += min(len(self._buf), size)
-        d = self._buf[:size]
-        self._buf = self._buf[size:]
-        return d
+            return d
+        b = bytearray(size)
+        n = self.__readinto(b)
+        del b[n:]
+        return bytes(b)
 
     def readinto(self, b):
-        with memoryview(b) as view, view.cast("B") as byte_view:
-            data = self.read(len(byte_view))
-            byte_view[:len(data)] = data
-        return len(data)
+        '''Decrypted data is copied to b directly if not compressed.'''
+        if self._decompressor is not None:
+            with memoryview(b) as view, view.cast("B") as byte_view:
+                data = self.read(len(byte_view))
+                byte_view[:len(data)] = data
+            return len(data)
+        if not self.readable():
+            raise ValueError('File is not readable.')
+        self.__check_crc32()
+        return self.__readinto(b)
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        '''Only supported when reading an uncompressed file in GCM
+        format. Only chunks after offset are decrypted.'''
+        if not self.seekable():
+            raise UnsupportedOperation('seek')
+        self.__check_crc32()
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self._length
+        offset = max(0, min(offset, self._length))
+        for i in self._ahead:
+            if not isinstance(i, bytes):
+                i.cancel()
+        self._ahead.clear()
+        self._index = offset // GCM_CHUNK
+        self._fp.seek(self._index * (GCM_CHUNK + GCM_TAG))
+        self._start = self._end = 0
+        self._pos = offset
+        skip = offset % GCM_CHUNK
+        if skip and self.__read():
+            self._start = min(skip, self._end)
+        return self._pos
+
+    def seekable(self):
+        self._check_not_closed()
+        return self._mode == _MODE_READ and self._format == EncFormat.GCM and self._decompressor is None  # noqa: E501
 
     def tell(self):
         return self._pos
@@ -313,9 +484,33 @@ class EncFile(RawIOBase):
         if self._pos < self._crc_size:
             le = min(length, self._crc_size - self._pos)
             self._crc32 = crc32(data[:le], self._crc32)
-        self._fp.write(self._enc.update(data))
+        self.__write(data)
         self._pos += length
 
+    def __seal_chunk(self, index: int, data: bytes, final: bool) -> bytes:
+        return self._gcm.encrypt(self.__nonce(index), data, b'\x01' if final else b'\x00')  # noqa: E501
+
+    def __write(self, data: bytes):
+        if self._format != EncFormat.GCM:
+            self._fp.write(self._enc.update(data))
+            return
+        self._pending += data
+        # The last chunk is written by close().
+        if len(self._pending) > GCM_CHUNK:
+            with memoryview(self._pending) as v:
+                n = (len(self._pending) - 1) // GCM_CHUNK * GCM_CHUNK
+                for i in range(0, n, GCM_CHUNK):
+                    self.__put_chunk(bytes(v[i:i + GCM_CHUNK]), False)
+            del self._pending[:n]
+
+    def set_salt(self, salt: Union[bytes, str]):
+        '''Salt is only used by key. In write mode it can be set after all
+        data is written.'''
+        if isinstance(salt, str):
+            self._salt = digest_of(salt)
+        else:
+            self._salt = salt
+
     @property
     def key(self):
         if len(self._salt) < 32:
@@ -327,24 +522,48 @@ class EncFile(RawIOBase):
         return self._iv
 
 
-def encrypt_file(src: str, dest: str, f: File, name: str, prog: str, c: CompressConfig = None):  # noqa: E501
+def _salt32(h: str) -> bytes:
+    return digest_of(h)[:32].ljust(32, b'\x00')
+
+
+def rekey(key: str, old: str, new: str) -> str:
+    '''Return the key of a file encrypted with salt old, which can be used
+    with salt new.'''
+    k = b85decode(key)
+    return b85encode(bytes(a ^ b ^ c for a, b, c in zip(k, _salt32(old), _salt32(new)))).decode()  # noqa: E501
+
+
+def encrypt_file(src: str, dest: str, f: File, name: str, prog: str, c: CompressConfig = None, hash: bool = False, algorithm: str = None):  # noqa: E501
+    '''If hash is True, the hash of src is computed with algorithm while
+    reading and used as salt instead of f.hash. Return (stats, hash) in
+    this case.'''
     if exists(dest):
         remove(dest)
     mkdir_for_file(dest)
     cs = 4096 if c is None else c.chunk_size
-    with open(src, 'rb') as s:
-        with EncFile(dest, 'wb', f.hash, compress=c) as t:
+    sr = open(src, 'rb')
+    if hash:
+        sr = HashReader(sr, algorithm)
+    with sr as s:
+        with EncFile(dest, 'wb', b'' if hash else f.hash, compress=c,
+                     format=EncFormat.GCM) as t:
             a = s.read(cs)
             while a != b'':
                 t.write(a)
                 a = s.read(cs)
             del a
-        stats = EncryptStats(b85encode(t.key).decode(), b85encode(t.iv).decode(), t.crc32, c._method.value if c else None, t.tell() if c else None)  # noqa: E501
+            if hash:
+                t.set_salt(s.hash)
+        # Exported leveldb is larger than f.size.
+        le = t.tell() if c or t.tell() != f.size else None
+        stats = EncryptStats(b85encode(t.key).decode(), b85encode(t.iv).decode(), t.crc32, c._method.value if c else None, le, t.format.value)  # noqa: E501
     i = compress_info(f.size, getsize(dest))
     if c is None:
         print(f'{prog}: Encrypted {src}({name}) -> {dest} ({i})')
     else:
         print(f'{prog}: Compressed and encrypted {src}({name}) -> {dest} ({i})')  # noqa: E501
+    if hash:
+        return stats, sr.hash
     return stats
 
 
@@ -355,14 +574,13 @@ def decrypt_file(src: str, dest: str, f: File, name: str, prog: str, c: Compress
     if exists(dest):
         remove(dest)
     mkdir_for_file(dest)
-    cs = 4096 if c is None else c.chunk_size
-    with EncFile(src, 'rb', f.hash, f.key, f.iv, f.encrypt_file_size, f.crc32, c) as s:  # noqa: E501
-        with open(dest, 'wb') as t:
-            a = s.read(cs)
-            while a != b'':
-                t.write(a)
-                a = s.read(cs)
-            del a
+    buf = bytearray(READ_BLOCK if c is None else c.chunk_size)
+    with EncFile(src, 'rb', f.hash, f.key, f.iv, f.encrypt_file_size, f.crc32, c, f.enc_format) as s:  # noqa: E501
+        with open(dest, 'wb') as t, memoryview(buf) as v:
+            n = s.readinto(v)
+            while n:
+                t.write(v[:n])
+                n = s.readinto(v)
     i = compress_info(f.size, getsize(src))
     if c is None:
         print(f'{prog}: Decrypted {src}({name}) -> {dest} ({i})')
@@ -1,10 +1,18 @@
-from collections import namedtuple
+from collections import deque, namedtuple
 from os.path import exists, dirname, abspath, isfile, isdir, join, isabs
-from os import stat, makedirs, listdir, remove
-from game_backuper.hashl import sha512
-from shutil import copy2
+from os.path import getsize
+from os import stat, makedirs, remove, scandir, walk
+import errno
+import os
+from game_backuper.hashl import HashReader, hash_file
+from shutil import copyfileobj, copystat
 from game_backuper.filetype import FileType
 from platform import system
+from time import time_ns
+from typing import Callable, Dict, Iterator, List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import Lock
 if system() == "Windows":
     try:
         from game_backuper.cfapi import hydrate_file, unpin_file
@@ -13,9 +21,21 @@ if system() == "Windows":
         have_cfapi = False
 else:
     have_cfapi = False
+try:
+    from fcntl import ioctl
+    have_ficlone = system() == "Linux"
+except ImportError:
+    have_ficlone = False
 
 
-_File = namedtuple('File', ['id', 'file', 'size', 'program', 'hash', 'type', 'key', 'iv', 'crc32', 'x_compress_type', 'compressed_size'])  # noqa: E501
+# Number of threads listing directories in walk_files.
+WALK_WORKERS = 8
+# _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+COPY_BLOCK = 1048576
+
+
+_File = namedtuple('File', ['id', 'file', 'size', 'program', 'hash', 'type', 'key', 'iv', 'crc32', 'x_compress_type', 'compressed_size', 'mtime', 'inode', 'ctime', 'enc_format'], defaults=(None, None, None, None))  # noqa: E501
 
 
 class File(_File):
@@ -36,6 +56,13 @@ class File(_File):
     def encrypt_file_size(self):
         return self.compressed_size if self.compressed_size else self.size
 
+    @property
+    def stat_tuple(self):
+        '''(size, mtime_ns, inode, ctime_ns) of source file. None if unknown'''
+        if self.mtime is None:
+            return None
+        return (self.size, self.mtime, self.inode, self.ctime)
+
     @classmethod
     def from_encrypt_stats(cls, stats, file):
         from game_backuper.enc import EncryptStats
@@ -43,7 +70,7 @@ class File(_File):
             raise TypeError(f'Expected EncryptStats, got {type(stats)}')
         if not isinstance(file, (File, _File)):
             raise TypeError(f'Expected File, got {type(file)}')
-        return cls(file.id, file.file, file.size, file.program, file.hash, file.type, stats.key, stats.iv, stats.crc32, stats.x_compress_type, stats.compressed_size)  # noqa: E501
+        return cls(file.id, file.file, file.size, file.program, file.hash, file.type, stats.key, stats.iv, stats.crc32, stats.x_compress_type, stats.compressed_size, file.mtime, file.inode, file.ctime, stats.format)  # noqa: E501
 
     @classmethod
     def from_leveldb_stats(cls, stats):
@@ -56,27 +83,267 @@ class File(_File):
 def mkdir_for_file(p: str):
     d = dirname(abspath(p))
     if not exists(d):
-        makedirs(d)
+        makedirs(d, exist_ok=True)
+
+
+def _reflink(sfd: int, tfd: int) -> bool:
+    if not have_ficlone:
+        return False
+    try:
+        ioctl(tfd, FICLONE, sfd)
+        return True
+    except OSError:
+        return False
+
+
+def _copy_file_range(sfd: int, tfd: int, off: int, n: int) -> int:
+    return os.copy_file_range(sfd, tfd, n, off, off)
+
+
+def _sendfile(sfd: int, tfd: int, off: int, n: int) -> int:
+    os.lseek(tfd, off, os.SEEK_SET)
+    return os.sendfile(tfd, sfd, off, n)
 
 
-def copy_file(loc: str, dest: str, name: str, prog: str):
+_kernel_copy_funcs = []
+if hasattr(os, 'copy_file_range'):
+    _kernel_copy_funcs.append(_copy_file_range)
+if hasattr(os, 'sendfile') and system() == "Linux":
+    _kernel_copy_funcs.append(_sendfile)
+_UNSUPPORTED_ERRNOS = {errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF}  # noqa: E501
+
+
+def _kernel_copy(sfd: int, tfd: int, off: int, n: int) -> bool:
+    '''Copy n bytes at off of sfd to the same offset of tfd in kernel.
+    Return False if no kernel copy method is supported.'''
+    for func in _kernel_copy_funcs:
+        copied = 0
+        try:
+            while copied < n:
+                r = func(sfd, tfd, off + copied, n - copied)
+                if r == 0:
+                    break
+                copied += r
+            return True
+        except OSError as e:
+            if copied or e.errno not in _UNSUPPORTED_ERRNOS:
+                raise
+    return False
+
+
+def fast_copy(loc: str, dest: str, hash: bool = False, algorithm: str = None):
+    '''Copy loc to dest without moving data through userspace if possible.
+    A reflink (FICLONE) is tried first, then copy_file_range and sendfile.
+    If hash is True, every block is hashed with algorithm right before the
+    kernel copies it, so the copy is served from page cache. Return the
+    hash or None.'''
+    with open(loc, 'rb', buffering=0) as f, open(dest, 'wb') as t:
+        s = HashReader(f, algorithm) if hash else None
+        sfd = f.fileno()
+        tfd = t.fileno()
+        if _reflink(sfd, tfd):
+            if s is not None:
+                while s.read(COPY_BLOCK):
+                    pass
+        elif s is not None:
+            kernel = True
+            off = 0
+            d = s.read(COPY_BLOCK)
+            while d:
+                if kernel:
+                    kernel = _kernel_copy(sfd, tfd, off, len(d))
+                if not kernel:
+                    t.seek(off)
+                    t.write(d)
+                off += len(d)
+                d = s.read(COPY_BLOCK)
+        elif not _kernel_copy(sfd, tfd, 0, os.fstat(sfd).st_size):
+            copyfileobj(f, t, COPY_BLOCK)
+    copystat(loc, dest)
+    return s.hash if s is not None else None
+
+
+def copy_file(loc: str, dest: str, name: str, prog: str, hash: bool = False,
+              algorithm: str = None):
+    '''If hash is True, return the hash of loc computed with algorithm while
+    copying.'''
     mkdir_for_file(dest)
-    r = copy2(loc, dest)
-    print(f'{prog}: Copyed {loc}({name}) -> {r}')
+    r = fast_copy(loc, dest, hash, algorithm)
+    print(f'{prog}: Copyed {loc}({name}) -> {dest}')
+    return r
 
 
-def listdirs(loc: str, ignore_hidden_files: bool = True):
-    bl = listdir(loc)
-    r = []
-    for i in bl:
-        if i.startswith('.'):
-            if ignore_hidden_files or i == '.' or i == '..':
-                continue
-        p = join(loc, i)
-        if isfile(p):
-            r.append(p)
-        elif isdir(p):
-            r += listdirs(p)
+class DirCache:
+    '''Listings of directories keyed by path. A cached listing is only used
+    if the mtime of the directory is unchanged.'''
+    def __init__(self, data: Dict[str, Tuple[int, List[str], List[str]]] = None,  # noqa: E501
+                 rescan: bool = False):
+        self._data = data if data is not None else {}
+        self._rescan = rescan
+        self._updated = {}
+        self._lock = Lock()
+        # Directories looked up and programs completely listed since last
+        # pop_unused.
+        self._touched = set()
+        self._complete = set()
+
+    def complete(self, name: str):
+        '''Mark that all directories of program name are listed.'''
+        with self._lock:
+            self._complete.add(name)
+
+    def lookup(self, loc: str, mtime: int) -> Tuple[List[str], List[str]]:
+        '''Return (files, dirs) of loc or None.'''
+        self._touched.add(loc)
+        if self._rescan:
+            return None
+        d = self._data.get(loc)
+        if d is not None and d[0] == mtime:
+            return d[1], d[2]
+
+    def pop_unused(self, names: List[str]) -> List[str]:
+        '''If all programs names are completely listed, forget directories
+        which are not looked up since last call and return them. Otherwise
+        return an empty list.'''
+        with self._lock:
+            ok = self._complete.issuperset(names)
+            touched = self._touched
+            self._touched = set()
+            self._complete = set()
+            if not ok:
+                return []
+            r = [i for i in self._data if i not in touched]
+            for i in r:
+                del self._data[i]
+            return r
+
+    def pop_updated(self) -> Dict[str, Tuple[int, List[str], List[str]]]:
+        with self._lock:
+            r = self._updated
+            self._updated = {}
+            return r
+
+    def store(self, loc: str, mtime: int, files: List[str], dirs: List[str]):
+        # A directory changed in the same second as it was listed may change
+        # again without changing mtime.
+        if time_ns() - mtime < 1000000000:
+            return
+        with self._lock:
+            self._data[loc] = self._updated[loc] = (mtime, files, dirs)
+
+
+def _stat_files(loc: str, names: List[str]):
+    files = []
+    stats = []
+    for i in names:
+        try:
+            stats.append(stat(join(loc, i)))
+        except OSError:
+            continue
+        files.append(i)
+    return files, stats
+
+
+def _listdir(loc: str, cache: DirCache = None, with_stat: bool = False):
+    '''Return (files, dirs, stats). If with_stat is True, stats are
+    stat_result of files, otherwise they are None.'''
+    if cache is not None:
+        mtime = stat(loc).st_mtime_ns
+        r = cache.lookup(loc, mtime)
+        if r is not None:
+            if with_stat:
+                files, stats = _stat_files(loc, r[0])
+                return files, r[1], stats
+            return r[0], r[1], [None] * len(r[0])
+    files = []
+    dirs = []
+    stats = []
+    with scandir(loc) as it:
+        for i in it:
+            if i.is_file():
+                try:
+                    st = i.stat() if with_stat else None
+                except OSError:
+                    continue
+                files.append(i.name)
+                stats.append(st)
+            elif i.is_dir():
+                dirs.append(i.name)
+    if cache is not None:
+        cache.store(loc, mtime, files, dirs)
+    return files, dirs, stats
+
+
+def scan_files(loc: str, ignore_hidden_files: bool = True,
+               cache: DirCache = None,
+               workers: int = WALK_WORKERS,
+               prune: Callable[[str], bool] = None,
+               with_stat: bool = True) -> Iterator[Tuple[str, os.stat_result]]:  # noqa: E501
+    '''Yield (path, stat) of all files in loc recursively. Sibling
+    directories are listed (and files are stated if with_stat is True) in
+    parallel by workers threads while files are being consumed. If cache
+    is given, unchanged directories are not listed again. Sub directories
+    for which prune returns True are skipped.'''
+    with ThreadPoolExecutor(workers, 'Walker') as ex:
+        # Hidden sub directories are always ignored, like old listdirs.
+        todo = deque([(loc, ignore_hidden_files)])
+        listing = deque()
+        while todo or listing:
+            while todo and len(listing) < workers * 2:
+                d, ih = todo.popleft()
+                listing.append((d, ih, ex.submit(_listdir, d, cache, with_stat)))  # noqa: E501
+            d, ih, fut = listing.popleft()
+            files, dirs, stats = fut.result()
+            for i in dirs:
+                if not (ih and i.startswith('.')):
+                    p = join(d, i)
+                    if prune is None or not prune(p):
+                        todo.append((p, True))
+            for i, st in zip(files, stats):
+                if not (ih and i.startswith('.')):
+                    yield join(d, i), st
+
+
+def walk_files(loc: str, ignore_hidden_files: bool = True,
+               cache: DirCache = None,
+               workers: int = WALK_WORKERS,
+               prune: Callable[[str], bool] = None) -> Iterator[str]:
+    '''Yield all files in loc recursively. See scan_files.'''
+    for p, _ in scan_files(loc, ignore_hidden_files, cache, workers, prune,
+                           False):
+        yield p
+
+
+def listdirs(loc: str, ignore_hidden_files: bool = True,
+             cache: DirCache = None):
+    return list(walk_files(loc, ignore_hidden_files, cache))
+
+
+def dir_state(loc: str) -> Dict[str, Tuple[int, int]]:
+    '''Return {name: (size, mtime)} of files in loc. Used to tell whether
+    loc is changed later.'''
+    r = {}
+    try:
+        with scandir(loc) as it:
+            for i in it:
+                try:
+                    st = i.stat()
+                except OSError:
+                    continue
+                r[i.name] = (st.st_size, st.st_mtime_ns)
+    except OSError:
+        pass
+    return r
+
+
+def get_dir_size(loc: str) -> int:
+    r = 0
+    for root, _, files in walk(loc):
+        for i in files:
+            try:
+                r += getsize(join(root, i))
+            except OSError:
+                pass
     return r
 
 
@@ -92,8 +359,8 @@ def list_all_paths(base: str, cli):
             if isfile(bp):
                 r.append(bp)
             elif isdir(bp):
-                re = listdirs(bp, c.ignore_hidden_files)
-                for ii in re:
+                prune = partial(c.is_exclude, bp) if c.excludes else None
+                for ii in walk_files(bp, c.ignore_hidden_files, prune=prune):
                     if c.is_exclude(bp, ii):
                         continue
                     if not c.is_include(bp, ii):
@@ -104,12 +371,28 @@ def list_all_paths(base: str, cli):
     return r
 
 
-def new_file(loc: str, name: str, prog: str, type: FileType = None) -> File:
-    if exists(loc):
-        fs = stat(loc).st_size
-        with open(loc, 'rb') as f:
-            hs = sha512(f)
-        return File(None, name, fs, prog, hs, type, None, None, None, None, None)  # noqa: E501
+def new_file(loc: str, name: str, prog: str, type: FileType = None,
+             cached: File = None, hash: bool = True,
+             algorithm: str = None, st: os.stat_result = None) -> File:
+    '''Create File from loc. If cached is given and the stat tuple of loc is
+    unchanged, the hash stored in cached is reused without reading loc.
+    If hash is False, loc is not read and hash is None unless cached.
+    Otherwise loc is hashed with algorithm. If st is given, it is used as
+    the stat of loc.'''
+    if st is not None or exists(loc):
+        if st is None:
+            st = stat(loc)
+        fs = st.st_size
+        stt = (fs, st.st_mtime_ns, st.st_ino, st.st_ctime_ns)
+        # A row without hash was added by a failed backup.
+        if cached is not None and cached.hash is not None and cached.stat_tuple == stt:  # noqa: E501
+            hs = cached.hash
+        elif not hash:
+            hs = None
+        else:
+            with open(loc, 'rb') as f:
+                hs = hash_file(f, algorithm)[0]
+        return File(None, name, fs, prog, hs, type, None, None, None, None, None, *stt[1:])  # noqa: E501
 
 
 def remove_dirs(loc: str):
@@ -4,3 +4,4 @@ from enum import IntEnum, unique
 @unique
 class FileType(IntEnum):
     LEVELDB = 0
+    CHUNKED = 1
@@ -1,12 +1,103 @@
-from hashlib import sha512 as _sha512
-from base64 import b85encode
-from typing import BinaryIO
+try:
+    from blake3 import blake3 as _blake3
+    have_blake3 = True
+except ImportError:
+    have_blake3 = False
+try:
+    from xxhash import xxh3_128 as _xxh3_128
+    have_xxhash = True
+except ImportError:
+    have_xxhash = False
+from hashlib import blake2b as _blake2b, sha512 as _sha512
+from base64 import b85decode, b85encode
+from typing import BinaryIO, List
+
+
+# Hashes without a tag were computed with sha512 by old versions, so sha512
+# hashes are never tagged. Others are stored as "<algorithm>:<digest>".
+DEFAULT_ALGORITHM = 'sha512'
+ALGORITHMS = {'sha512': _sha512, 'blake2b': _blake2b}
+if have_blake3:
+    ALGORITHMS['blake3'] = _blake3
+if have_xxhash:
+    ALGORITHMS['xxh3'] = _xxh3_128
+READ_BLOCK = 1048576
+
+
+def algorithm_of(h: str) -> str:
+    '''Return the algorithm of hash h. None if h is None.'''
+    if h is None:
+        return None
+    i = h.find(':')
+    return DEFAULT_ALGORITHM if i < 0 else h[:i]
+
+
+def digest_of(h: str) -> bytes:
+    '''Return the raw digest of hash h.'''
+    return b85decode(h[h.find(':') + 1:])
+
+
+def format_hash(algorithm: str, digest: bytes) -> str:
+    d = b85encode(digest).decode()
+    if algorithm is None or algorithm == DEFAULT_ALGORITHM:
+        return d
+    return f'{algorithm}:{d}'
+
+
+def new_hasher(algorithm: str = None):
+    algorithm = algorithm or DEFAULT_ALGORITHM
+    if algorithm not in ALGORITHMS:
+        raise ValueError(f'Unsupported hash algorithm: {algorithm}')
+    return ALGORITHMS[algorithm]()
+
+
+def hash_file(f: BinaryIO, *algorithms: str) -> List[str]:
+    '''Hash f with all algorithms in one pass. Data is read into one reused
+    buffer. Files are not mapped, since a file truncated while being read
+    would raise SIGBUS.'''
+    algorithms = [i or DEFAULT_ALGORITHM for i in algorithms or (None,)]
+    hs = [new_hasher(i) for i in algorithms]
+    buf = bytearray(READ_BLOCK)
+    with memoryview(buf) as v:
+        n = f.readinto(v)
+        while n:
+            for h in hs:
+                h.update(v[:n])
+            n = f.readinto(v)
+    return [format_hash(a, h.digest()) for a, h in zip(algorithms, hs)]
 
 
 def sha512(b: BinaryIO):
     s = _sha512()
-    t = b.read(1024)
+    t = b.read(READ_BLOCK)
     while len(t) > 0:
         s.update(t)
-        t = b.read(1024)
+        t = b.read(READ_BLOCK)
     return b85encode(s.digest()).decode()
+
+
+class HashReader:
+    '''Wrap a binary file and feed all data read from it into the hash
+    algorithm.'''
+    def __init__(self, f: BinaryIO, algorithm: str = None):
+        self._f = f
+        self._algorithm = algorithm or DEFAULT_ALGORITHM
+        self._h = new_hasher(self._algorithm)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, val, tb):
+        self.close()
+
+    def close(self):
+        self._f.close()
+
+    @property
+    def hash(self) -> str:
+        return format_hash(self._algorithm, self._h.digest())
+
+    def read(self, size: int = -1) -> bytes:
+        d = self._f.read(size)
+        self._h.update(d)
+        return d
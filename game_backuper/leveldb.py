@@ -6,7 +6,7 @@ except ImportError:
 
 
 if have_leveldb:
-    from typing import List, Union
+    from typing import Iterator, List, Tuple, Union
     from hashlib import sha512
     from base64 import b85encode
     from collections import namedtuple
@@ -14,93 +14,130 @@ if have_leveldb:
     from os.path import exists
     from os import remove
     LeveldbStats = namedtuple('LeveldbStats', ['hash', 'size'])
+    # Entries are inserted in key order, so a WITHOUT ROWID table is built
+    # by appending to its only b-tree.
     MAP_TABLE = '''CREATE TABLE map (
     key TEXT,
     value TEXT,
     PRIMARY KEY(key)
-    )'''
+    ) WITHOUT ROWID'''
 
-    def list_leveldb_entries(db: Union[str, DB], dms: List[bytes] = None):
-        if isinstance(db, str):
-            d = DB(db)
-        else:
-            d = db
-        r = []
-        for i in d.iterator(include_value=False):
-            if isinstance(i, bytes):
-                if dms is None:
-                    r.append(i)
-                else:
-                    if i == b'VERSION':
-                        r.append(i)
-                    elif i.startswith(b'META:'):
-                        dm = i[5:]
-                        if dm in dms:
-                            r.append(i)
-                    elif i.startswith(b'_'):
-                        dmi = i.find(b'\x00\x01')
-                        dm = i[1:dmi]
-                        if dm in dms:
-                            r.append(i)
+    def _in_domains(k: bytes, dms: List[bytes]) -> bool:
+        if dms is None or k == b'VERSION':
+            return True
+        if k.startswith(b'META:'):
+            return k[5:] in dms
+        if k.startswith(b'_'):
+            return k[1:k.find(b'\x00\x01')] in dms
+        return False
+
+    def _domain_ranges(dms: List[bytes]) -> List[Tuple[bytes, bool]]:
+        '''Return sorted (key, is_prefix) covering all entries in domains
+        dms. Ranges do not overlap, so entries read range by range are
+        sorted too.'''
+        r = [(b'VERSION', False)]
+        for dm in set(dms):
+            r.append((b'META:' + dm, False))
+            r.append((b'_' + dm + b'\x00\x01', True))
         r.sort()
-        if isinstance(db, str):
-            d.close()
         return r
 
-    def leveldb_stats(db: str, entries: List[bytes]) -> LeveldbStats:
-        d = DB(db)
-        h = sha512()
-        le = 0
-        for e in entries:
-            v = d.get(e)
-            if v is not None:
-                h.update(e)
-                h.update(v)
-                le += len(e) + len(v)
-        d.close()
-        return LeveldbStats(b85encode(h.digest()).decode(), le)
+    def iter_leveldb(db: Union[str, DB],
+                     dms: List[bytes] = None) -> Iterator[Tuple[bytes, bytes]]:  # noqa: E501
+        '''Yield sorted (key, value) of entries in domains dms from a
+        snapshot of db, so a running program can not change them while
+        iterating. Only key ranges of dms are read.'''
+        d = DB(db) if isinstance(db, str) else db
+        try:
+            with d.snapshot() as sn:
+                if dms is None:
+                    yield from sn.iterator()
+                    return
+                for k, prefix in _domain_ranges(dms):
+                    if prefix:
+                        yield from sn.iterator(prefix=k)
+                    else:
+                        v = sn.get(k)
+                        if v is not None:
+                            yield k, v
+        finally:
+            if isinstance(db, str):
+                d.close()
+
+    def list_leveldb_entries(db: Union[str, DB], dms: List[bytes] = None):
+        return [k for k, _ in iter_leveldb(db, dms)]
+
+    class _StatsCounter:
+        def __init__(self):
+            self._h = sha512()
+            self._size = 0
 
-    def leveldb_to_sqlite(db: str, dest: str, entries: List[bytes]):
-        d = DB(db)
+        def feed(self, it: Iterator[Tuple[bytes, bytes]]):
+            for k, v in it:
+                self._h.update(k)
+                self._h.update(v)
+                self._size += len(k) + len(v)
+                yield k, v
+
+        @property
+        def stats(self) -> LeveldbStats:
+            return LeveldbStats(b85encode(self._h.digest()).decode(), self._size)  # noqa: E501
+
+    def leveldb_stats(db: str, dms: List[bytes] = None) -> LeveldbStats:
+        c = _StatsCounter()
+        for _ in c.feed(iter_leveldb(db, dms)):
+            pass
+        return c.stats
+
+    def leveldb_to_sqlite(db: str, dest: str,
+                          dms: List[bytes] = None) -> LeveldbStats:
+        '''Export entries in domains dms to sqlite database dest. Stats
+        are computed in the same pass. Return stats.'''
         if exists(dest):
             remove(dest)
+        c = _StatsCounter()
         s = connect(dest)
-        s.text_factory = bytes
-        s.execute(MAP_TABLE)
-        for e in entries:
-            v = d.get(e)
-            if v is not None:
-                s.execute('INSERT INTO map VALUES (?, ?);', (e, v))
-        s.commit()
-        s.execute('VACUUM;')
-        s.commit()
-        d.close()
-        s.close()
+        try:
+            s.text_factory = bytes
+            # dest is a throwaway export, no need to journal.
+            s.execute('PRAGMA journal_mode=OFF;')
+            s.execute('PRAGMA synchronous=OFF;')
+            s.execute(MAP_TABLE)
+            s.executemany('INSERT INTO map VALUES (?, ?);',
+                          c.feed(iter_leveldb(db, dms)))
+            s.commit()
+        finally:
+            s.close()
+        return c.stats
 
-    def sqlite_to_leveldb(db: str, dest: str, dms: List[bytes]):
+    def sqlite_to_leveldb(db: str, dest: str, dms: List[bytes],
+                          batch_size: int = 0):
+        '''Restore entries in domains dms from sqlite database db to leveldb
+        dest. Changes are written in batches of batch_size. 0 means one
+        atomic batch. New values are written before old keys are deleted,
+        so an interrupted restore never loses keys.'''
         s = connect(db)
         s.text_factory = bytes
         d = DB(dest, create_if_missing=True)
         try:
-            ents = list_leveldb_entries(d, dms)
-            for i in ents:
-                d.delete(i)
-            cur = s.execute('SELECT * FROM map;')
-            for i in cur:
-                if dms is None:
-                    d.put(i[0], i[1])
-                else:
-                    if i[0] == b'VERSION':
-                        d.put(i[0], i[1])
-                    elif i[0].startswith(b'META:'):
-                        dm = i[0][5:]
-                        if dm in dms:
-                            d.put(i[0], i[1])
-                    elif i[0].startswith(b'_'):
-                        dmi = i[0].find(b'\x00\x01')
-                        dm = i[0][1:dmi]
-                        if dm in dms:
-                            d.put(i[0], i[1])
+            old = set(list_leveldb_entries(d, dms))
+            b = d.write_batch()
+            n = 0
+            for k, v in s.execute('SELECT key, value FROM map;'):
+                if _in_domains(k, dms):
+                    old.discard(k)
+                    b.put(k, v)
+                    n += 1
+                    if batch_size and n % batch_size == 0:
+                        b.write()
+                        b.clear()
+            for k in old:
+                b.delete(k)
+                n += 1
+                if batch_size and n % batch_size == 0:
+                    b.write()
+                    b.clear()
+            b.write()
         except Exception:
             from traceback import print_exc
             print_exc()
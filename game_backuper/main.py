@@ -21,8 +21,10 @@ def main(cm=None):
             have_snappy,
             have_zstd,
         )
+        from game_backuper.chunk import have_fastcdc
         from game_backuper.leveldb import have_leveldb
         from game_backuper.regexp import have_pcre2
+        from game_backuper.hashl import have_blake3, have_xxhash
         print("Brotli support:", have_brotli)
         print("BZip2 support:", have_bz2)
         print("GZip support:", have_gzip)
@@ -32,10 +34,16 @@ def main(cm=None):
         print("ZSTD support:", have_zstd)
         print("LevelDB support:", have_leveldb)
         print("PCRE2 support:", have_pcre2)
+        print("FastCDC extension:", have_fastcdc)
+        print("BLAKE3 support:", have_blake3)
+        print("xxHash support:", have_xxhash)
         return 0
     cfg = Config(cml.config_file)
     if not exists(cfg.dest):
         makedirs(cfg.dest)
     db = Db(cfg, cml)
-    bk = Backuper(db, cfg, cml)
-    return bk.run()
+    try:
+        bk = Backuper(db, cfg, cml)
+        return bk.run()
+    finally:
+        db.close()
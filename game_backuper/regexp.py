@@ -5,6 +5,7 @@ except ImportError:
     have_pcre2 = False
 from enum import IntFlag
 from re import I as REI, compile as re_comp
+from typing import List
 
 
 class RegexFlag(IntFlag):
@@ -14,6 +15,7 @@ class RegexFlag(IntFlag):
 
 class Regex:
     def __init__(self, r: str, flags: RegexFlag = 0, use_pcre2: bool = False):
+        self.pattern = r
         if have_pcre2 and use_pcre2:
             opt = 0
             if flags & RegexFlag.I:
@@ -43,6 +45,32 @@ class Regex:
             return False if self._re.match(s, startpos) is None else True
 
 
+class RegexSet:
+    '''Match any of regexes. Regexes are joined into one alternation if
+    possible, so a string is matched once instead of once per regex.'''
+    def __init__(self, li: List[Regex]):
+        self._li = li
+        self._re = None
+        # Group numbers are changed after joining.
+        if len(li) > 1 and not any(_BACKREF.search(i.pattern) for i in li):
+            p = '|'.join(f'(?:{i.pattern})' for i in li)
+            try:
+                self._re = Regex(p, use_pcre2=all(i._use_pcre2 for i in li))  # noqa: E501
+            except Exception:
+                pass
+
+    def match_only(self, s: str) -> bool:
+        if self._re is not None:
+            return self._re.match_only(s)
+        for i in self._li:
+            if i.match_only(s):
+                return True
+        return False
+
+
+_BACKREF = re_comp(r'\\[1-9]|\(\?P=')
+
+
 def wildcards_to_regex(s: str, **k):
     for i in ['\\', '$', '(', ')', '+', '.', '[', '^', '{', '|']:
         s = s.replace(i, f"\\{i}")
@@ -0,0 +1,199 @@
+from concurrent.futures import ProcessPoolExecutor
+from heapq import heappop, heappush
+from itertools import count
+from multiprocessing import get_all_start_methods, get_context
+from threading import Condition, Thread
+from traceback import print_exc
+
+
+# Default number of queued jobs per thread.
+QUEUE_PER_JOB = 64
+
+
+class Scheduler:
+    '''Run file-level jobs of all tasks on a fixed number of threads.
+
+    A task provides ``name``, ``workers`` (max running jobs of the task,
+    None means no limit), ``jobs()`` which yields ``(size, func, arg)`` and
+    ``finish()`` which is called once all jobs of the task are done. Jobs
+    are consumed by a feeder thread while workers are running, so work
+    starts before all jobs are listed. Larger queued jobs are started first.
+    At most max_queued jobs of a task are queued. The feeder lists jobs of
+    other tasks meanwhile and waits once all queues are full, so memory
+    does not grow with the number of files and a task with few workers does
+    not hold back the others. If a job failed, ``finish()`` is not
+    called.'''
+    def __init__(self, jobs: int, max_queued: int = None):
+        if jobs < 1:
+            raise ValueError('jobs should be a positive integer.')
+        self._jobs = jobs
+        self._max_queued = max_queued if max_queued else jobs * QUEUE_PER_JOB
+        # Queued jobs of each task, largest first.
+        self._queues = {}
+        # (top job of a task, task) of tasks which may run a job. Entries
+        # become stale if the top job or workers of the task changed, they
+        # are dropped when popped.
+        self._ready = []
+        self._queued = 0
+        self._seq = count()
+        self._cond = Condition()
+        self._tasks = []
+        self._running = {}
+        self._pending = {}
+        self._failed = set()
+        self._fed = set()
+        self._feeding = False
+
+    def __done(self, task) -> bool:
+        return self._pending[task] == 0 and task in self._fed and task not in self._failed  # noqa: E501
+
+    def __feed(self):
+        try:
+            feeding = []
+            for task in self._tasks:
+                try:
+                    feeding.append((task, iter(task.jobs())))
+                except Exception:
+                    self.__feed_failed(task)
+            while feeding:
+                with self._cond:
+                    while all(len(self._queues[t]) >= self._max_queued
+                              for t, _ in feeding):
+                        self._cond.wait()
+                feeding = [i for i in feeding if self.__feed_task(*i)]
+        finally:
+            with self._cond:
+                self._feeding = False
+                self._cond.notify_all()
+
+    def __feed_failed(self, task):
+        print(f'{task.name}: Failed to list jobs.')
+        print_exc()
+        with self._cond:
+            self._failed.add(task)
+        self.__fed(task)
+
+    def __feed_task(self, task, it) -> bool:
+        '''Queue jobs of task until its queue is full. Return False if all
+        jobs of task are listed.'''
+        q = self._queues[task]
+        try:
+            while True:
+                with self._cond:
+                    if len(q) >= self._max_queued:
+                        return True
+                try:
+                    size, func, arg = next(it)
+                except StopIteration:
+                    break
+                with self._cond:
+                    seq = next(self._seq)
+                    heappush(q, (-size, seq, func, arg))
+                    self._pending[task] += 1
+                    self._queued += 1
+                    if q[0][1] == seq:
+                        self.__push_ready(task)
+                        self._cond.notify()
+        except Exception:
+            self.__feed_failed(task)
+            return False
+        self.__fed(task)
+        return False
+
+    def __fed(self, task):
+        with self._cond:
+            self._fed.add(task)
+            done = self.__done(task)
+        if done:
+            self.__finish(task)
+
+    def __pop(self):
+        while self._ready:
+            size, seq, task = heappop(self._ready)
+            q = self._queues[task]
+            if not q or q[0][1] != seq or not self.__runnable(task):
+                continue
+            job = heappop(q)
+            self._queued -= 1
+            self._running[task] += 1
+            self.__push_ready(task)
+            return task, job
+        return None
+
+    def __push_ready(self, task):
+        q = self._queues[task]
+        if q and self.__runnable(task):
+            heappush(self._ready, (q[0][0], q[0][1], task))
+
+    def __runnable(self, task) -> bool:
+        return task.workers is None or self._running[task] < task.workers
+
+    def __finish(self, task):
+        try:
+            task.finish()
+        except Exception:
+            print(f'{task.name}: Failed to finish task.')
+            print_exc()
+
+    def __worker(self):
+        while True:
+            with self._cond:
+                while True:
+                    r = self.__pop()
+                    if r is not None:
+                        break
+                    if not self._queued and not self._feeding:
+                        return
+                    self._cond.wait()
+            task, job = r
+            ok = True
+            try:
+                job[2](job[3])
+            except Exception:
+                print(f'{task.name}: Failed to process {job[3]}.')
+                print_exc()
+                ok = False
+            with self._cond:
+                self._running[task] -= 1
+                self._pending[task] -= 1
+                self.__push_ready(task)
+                if not ok:
+                    self._failed.add(task)
+                done = self.__done(task)
+                self._cond.notify_all()
+            if done:
+                self.__finish(task)
+
+    def add_task(self, task):
+        self._tasks.append(task)
+        self._queues[task] = []
+        self._running[task] = 0
+        self._pending[task] = 0
+
+    def run(self):
+        self._feeding = True
+        threads = [Thread(target=self.__feed, name="Feeder")]
+        for i in range(self._jobs):
+            threads.append(Thread(target=self.__worker, name=f"Worker_{i}"))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+
+def new_process_pool(processes: int) -> ProcessPoolExecutor:
+    '''Return a process pool whose workers are not forked from this
+    process. Workers are started lazily, when threads are already running,
+    and a forked worker would inherit their locks and thread pools.'''
+    methods = get_all_start_methods()
+    ctx = get_context('forkserver' if 'forkserver' in methods else 'spawn')
+    return ProcessPoolExecutor(processes, mp_context=ctx)
+
+
+def run_in_pool(pool: ProcessPoolExecutor, func, *args):
+    '''Run func in pool and wait for result. Run it directly if pool is None.
+    Only paths and small objects should be passed, the worker process reads
+    and writes files by itself.'''
+    if pool is None:
+        return func(*args)
+    return pool.submit(func, *args).result()
@@ -0,0 +1,255 @@
+from base64 import b85encode
+from hashlib import sha512
+from os import close, remove, walk
+from os.path import exists, join, relpath
+from random import random
+from sqlite3 import connect
+from tempfile import mkstemp
+from threading import Lock
+from time import monotonic, sleep
+from typing import Iterator, List, Set, Tuple
+from game_backuper.chunk import ChunkStore
+from game_backuper.cml import Opts
+from game_backuper.compress import (
+    CompressConfig,
+    iter_decompressed,
+    sizeof_fmt,
+    supported_exts,
+)
+from game_backuper.config import Config, Program
+from game_backuper.db import Db, DbWriter
+from game_backuper.enc import READ_BLOCK, EncFile
+from game_backuper.file import File, hydrate_file_if_needed
+from game_backuper.filetype import FileType
+from game_backuper.hashl import algorithm_of, format_hash, new_hasher
+
+
+class RateLimiter:
+    '''Limit the total speed of all threads to rate bytes per second.'''
+    def __init__(self, rate: int):
+        self._rate = rate
+        self._lock = Lock()
+        self._next = monotonic()
+
+    def consume(self, n: int):
+        with self._lock:
+            now = monotonic()
+            t = max(self._next, now)
+            self._next = t + n / self._rate
+        if t > now:
+            sleep(t - now)
+
+
+class VerifyStats:
+    def __init__(self):
+        self._lock = Lock()
+        self.verified = 0
+        self.skipped = 0
+        self.missing = 0
+        self.corrupted = 0
+        self.orphaned = 0
+        self.size = 0
+
+    def add(self, key: str, size: int = 0):
+        with self._lock:
+            setattr(self, key, getattr(self, key) + 1)
+            self.size += size
+
+    @property
+    def ok(self) -> bool:
+        return not (self.missing or self.corrupted or self.orphaned)
+
+    def __str__(self) -> str:
+        return f'Verified {self.verified} files ({sizeof_fmt(self.size)}), skipped {self.skipped}, missing {self.missing}, corrupted {self.corrupted}, orphaned {self.orphaned}.'  # noqa: E501
+
+
+class MissingError(Exception):
+    pass
+
+
+def _map_stats(fn: str) -> Tuple[str, int]:
+    '''Return (hash, size) of a leveldb exported by leveldb_to_sqlite, which
+    are the same as leveldb_stats of the original leveldb.'''
+    s = connect(fn)
+    s.text_factory = bytes
+    h = sha512()
+    le = 0
+    try:
+        for k, v in s.execute('SELECT key, value FROM map ORDER BY key;'):
+            h.update(k)
+            h.update(v)
+            le += len(k) + len(v)
+    finally:
+        s.close()
+    return b85encode(h.digest()).decode(), le
+
+
+class VerifyTask:
+    def __init__(self, prog: Program, db: Db, cfg: Config, opts: Opts,
+                 writer: DbWriter, stats: VerifyStats,
+                 limiter: RateLimiter = None, store: ChunkStore = None):
+        self.name = f"Verify_{prog.name}"
+        self.cfg = cfg
+        self.prog = prog
+        self.db = db
+        self.opts = opts
+        self.writer = writer
+        self.stats = stats
+        self.limiter = limiter
+        self.store = store if store else ChunkStore(cfg.dest, db)
+        self.workers = prog.workers
+
+    def __iter_chunks(self, f: File) -> Iterator[bytes]:
+        for ch in self.db.get_file_chunks(f.id):
+            if ch.size is None or not exists(self.store.chunk_path(ch.hash)):
+                raise MissingError(f'chunk {ch.hash}')
+            yield self.store.read_chunk(ch)
+
+    def __iter_object(self, f: File, src: str,
+                      c: CompressConfig) -> Iterator[bytes]:
+        if not exists(src):
+            raise MissingError(f'"{src}"')
+        hydrate_file_if_needed(src)
+        if f.encrypted:
+            ec = CompressConfig(f.compressed_type.to_str()) if f.compressed else None  # noqa: E501
+            with EncFile(src, 'rb', f.hash, f.key, f.iv, f.encrypt_file_size, f.crc32, ec, f.enc_format) as s:  # noqa: E501
+                d = s.read(READ_BLOCK)
+                while d:
+                    yield d
+                    d = s.read(READ_BLOCK)
+        elif c is not None:
+            yield from iter_decompressed(src, c)
+        else:
+            with open(src, 'rb') as s:
+                d = s.read(READ_BLOCK)
+                while d:
+                    yield d
+                    d = s.read(READ_BLOCK)
+
+    def __source(self, f: File) -> Tuple[str, CompressConfig]:
+        prog = self.prog.name
+        dest = self.cfg.dest
+        fn = f.file + '.db' if f.type == FileType.LEVELDB else f.file
+        if f.encrypted:
+            src = join(dest, '.encrypt', prog, fn)
+            if not exists(src):
+                src = join(dest, '.encrypt', '.id', str(f.id))
+            return src, None
+        r = self.prog.get_config(f.file)
+        c = r.compress_config if r is not None else None
+        src = join(dest, prog, fn)
+        return (src + c.ext, c) if c else (src, None)
+
+    def expected_paths(self, index: List[File]) -> Tuple[Set[str], Set[str]]:
+        '''Return names which may be used by files in dest/<prog> and
+        dest/.encrypt/<prog>.'''
+        plain = set()
+        enc = set()
+        for f in index:
+            if f.type == FileType.CHUNKED:
+                continue
+            fn = f.file + '.db' if f.type == FileType.LEVELDB else f.file
+            if f.encrypted:
+                enc.add(fn)
+            else:
+                plain.add(fn)
+                plain.update(fn + i for i in supported_exts)
+        return plain, enc
+
+    def finish(self):
+        # All files are verified. Next verify starts over.
+        self.writer.submit(self.db.clear_verified, self.prog.name)
+        prog = self.prog.name
+        plain, enc = self.expected_paths(self._index)
+        for b, names in ((join(self.cfg.dest, prog), plain),
+                         (join(self.cfg.dest, '.encrypt', prog), enc)):
+            for root, _, files in walk(b):
+                for i in files:
+                    p = join(root, i)
+                    if relpath(p, b) not in names:
+                        print(f'{prog}: Orphaned {p}')
+                        self.stats.add('orphaned')
+
+    def jobs(self):
+        prog = self.prog.name
+        self._index = list(self.db.load_program_index(prog).values())
+        done = {} if self.opts.restart else self.db.get_verified(prog)
+        for f in self._index:
+            if f.hash is not None and done.get(f.id) == f.hash:
+                self.stats.add('skipped')
+                continue
+            if self.opts.sample is not None and random() >= self.opts.sample:  # noqa: E501
+                self.stats.add('skipped')
+                continue
+            yield f.size, self.verify_file, f
+
+    def verify_file(self, f: File):
+        prog = self.prog.name
+        fn = f.file
+        if f.hash is None:
+            print(f'{prog}: Missing {fn}: backup is incomplete.')
+            self.stats.add('missing')
+            return
+        alg = algorithm_of(f.hash)
+        h = new_hasher(alg)
+        size = 0
+        tmp = None
+        try:
+            if f.type == FileType.CHUNKED:
+                it = self.__iter_chunks(f)
+            else:
+                it = self.__iter_object(f, *self.__source(f))
+            if f.type == FileType.LEVELDB:
+                fd, tmp = mkstemp()
+                close(fd)
+                with open(tmp, 'wb') as t:
+                    for d in it:
+                        if self.limiter:
+                            self.limiter.consume(len(d))
+                        t.write(d)
+                hs, size = _map_stats(tmp)
+            else:
+                for d in it:
+                    if self.limiter:
+                        self.limiter.consume(len(d))
+                    h.update(d)
+                    size += len(d)
+                hs = format_hash(alg, h.digest())
+        except MissingError as e:
+            print(f'{prog}: Missing {fn}: {e}')
+            self.stats.add('missing')
+            return
+        except Exception as e:
+            print(f'{prog}: Corrupted {fn}: {e}')
+            self.stats.add('corrupted')
+            return
+        finally:
+            if tmp is not None:
+                remove(tmp)
+        if size != f.size or hs != f.hash:
+            print(f'{prog}: Corrupted {fn}: hash or size dismatched.')
+            self.stats.add('corrupted')
+            return
+        print(f'{prog}: Verified {fn}')
+        self.stats.add('verified', size)
+        self.writer.submit(self.db.set_verified, f.id, f.hash)
+        self.writer.submit(self.db.checkpoint)
+
+
+def find_orphans(cfg: Config, db: Db, stats: VerifyStats):
+    '''Report files in dest/.encrypt/.id and chunks in dest/.chunks which are
+    not used by any file.'''
+    ids = set(str(i) for i in db.get_file_ids())
+    b = join(cfg.dest, '.encrypt', '.id')
+    for root, _, files in walk(b):
+        for i in files:
+            if root != b or i not in ids:
+                print(f'Orphaned {join(root, i)}')
+                stats.add('orphaned')
+    hashes = db.get_chunk_hashes()
+    b = join(cfg.dest, '.chunks')
+    for root, _, files in walk(b):
+        for i in files:
+            if i not in hashes:
+                print(f'Orphaned {join(root, i)}')
+                stats.add('orphaned')
@@ -0,0 +1,246 @@
+try:
+    from ctypes import CDLL, c_char_p, c_int, c_uint32, get_errno
+    from ctypes.util import find_library
+    from platform import system
+    if system() != "Linux":
+        raise ImportError('inotify is only available on Linux.')
+    _libc = CDLL(find_library('c'), use_errno=True)
+    _libc.inotify_init1.argtypes = [c_int]
+    _libc.inotify_add_watch.argtypes = [c_int, c_char_p, c_uint32]
+    have_inotify = True
+except (ImportError, OSError, AttributeError):
+    have_inotify = False
+from errno import ENOMEM, ENOSPC
+from os import close, fsencode, fsdecode, read, strerror, walk
+from os.path import dirname, isabs, isdir, join
+from select import select
+from struct import Struct
+from time import sleep
+from typing import Dict, List, Set
+from game_backuper.config import ConfigOLeveldb, ConfigPath, Program
+from game_backuper.file import dir_state
+
+
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF  # noqa: E501
+_EVENT = Struct('iIII')
+
+
+class Inotify:
+    def __init__(self):
+        self.fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = get_errno()
+            raise OSError(e, strerror(e))
+
+    def add_watch(self, path: str, mask: int = WATCH_MASK) -> int:
+        wd = _libc.inotify_add_watch(self.fd, fsencode(path), mask)
+        if wd < 0:
+            e = get_errno()
+            raise OSError(e, strerror(e), path)
+        return wd
+
+    def close(self):
+        close(self.fd)
+
+    def read(self, timeout: float = None):
+        '''Return a list of (wd, mask, name). Wait at most timeout seconds.
+        None means wait until any event is available.'''
+        r = select([self.fd], [], [], timeout)[0]
+        if not r:
+            return []
+        try:
+            data = read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        li = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, le = _EVENT.unpack_from(data, pos)
+            pos += _EVENT.size
+            name = fsdecode(data[pos:pos + le].rstrip(b'\0'))
+            pos += le
+            li.append((wd, mask, name))
+        return li
+
+
+class Watcher:
+    '''Back up changed files of programs continuously.
+
+    Configured paths are watched with inotify. Changes are collected until
+    no event arrives for cfg.watch_debounce seconds, then only touched
+    files and leveldb directories are backed up. If inotify is not
+    available or the watch limit is reached, all files are rescanned every
+    cfg.watch_rescan_interval seconds instead.'''
+    def __init__(self, bk, progs: List[Program]):
+        self.bk = bk
+        self.cfg = bk.conf
+        self.progs = progs
+        self._ino = None
+        # wd -> [directory, programs, watch new sub directories, is leveldb]
+        self._wd = {}
+        self._paths: Dict[Program, Set[str]] = {}
+        self._rescan: Set[Program] = set()
+
+    def __add_watch(self, prog: Program, d: str, recursive: bool,
+                    leveldb: bool = False):
+        if self._ino is None:
+            return
+        try:
+            wd = self._ino.add_watch(d)
+        except OSError as e:
+            if e.errno not in (ENOSPC, ENOMEM):
+                raise
+            # Watch limit is reached. Fall back to rescan.
+            print(f'Warn: Failed to watch "{e.filename}": {e.strerror}')
+            self.__stop_watch()
+            self._rescan.update(self.progs)
+            return
+        if wd in self._wd:
+            w = self._wd[wd]
+            w[1].add(prog)
+            w[2] = w[2] or recursive
+            w[3] = w[3] and leveldb
+        else:
+            self._wd[wd] = [d, {prog}, recursive, leveldb]
+
+    def __backup(self):
+        for prog in self.progs:
+            if prog in self._rescan:
+                self.bk.deal_prog(prog)
+            elif prog in self._paths:
+                self.bk.deal_prog(prog, self._paths[prog])
+        self._rescan.clear()
+        self._paths.clear()
+        self.bk.wait(False)
+        if self._ino is not None:
+            # Opening a leveldb writes to its directory. Drop events of a
+            # leveldb directory which is not changed since it was backed up,
+            # otherwise the leveldb is backed up again and again. Writes of
+            # other processes after it was closed are kept.
+            states = self.bk.leveldb_states
+            unchanged = {}
+            events = self._ino.read(0)
+            while events and self._ino is not None:
+                for wd, mask, name in events:
+                    if self._ino is None:
+                        break
+                    w = self._wd.get(wd)
+                    if w is not None and w[3] and w[0] in states:
+                        d = w[0]
+                        if d not in unchanged:
+                            unchanged[d] = dir_state(d) == states[d]
+                        if unchanged[d]:
+                            continue
+                    self.__handle(wd, mask, name)
+                if self._ino is not None:
+                    events = self._ino.read(0)
+            states.clear()
+
+    def __handle(self, wd: int, mask: int, name: str):
+        if mask & IN_Q_OVERFLOW:
+            self._rescan.update(self.progs)
+            return
+        if wd not in self._wd:
+            return
+        d, progs, recursive, _ = self._wd[wd]
+        if mask & IN_IGNORED:
+            del self._wd[wd]
+            return
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            self._rescan.update(progs)
+            return
+        p = join(d, name)
+        if mask & IN_ISDIR:
+            if not recursive:
+                return
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                for prog in progs:
+                    self.__watch_dir(prog, p, True)
+                for root, _, files in walk(p):
+                    for i in files:
+                        for prog in progs:
+                            self.__touch(prog, join(root, i))
+            else:
+                # Files in it may be removed.
+                self._rescan.update(progs)
+            return
+        for prog in progs:
+            self.__touch(prog, p)
+
+    def __rescan_loop(self):
+        t = self.cfg.watch_rescan_interval
+        print(f'Can not watch files. Rescan all files every {t} seconds.')
+        while True:
+            sleep(t)
+            self._rescan.update(self.progs)
+            self.__backup()
+
+    def __setup(self):
+        self._ino = Inotify()
+        for prog in self.progs:
+            b = prog.base
+            for c in prog.all_configs:
+                p = c.path if isabs(c.path) else join(b, c.path)
+                if isinstance(c, ConfigPath):
+                    if isdir(p):
+                        self.__watch_dir(prog, p, True)
+                    else:
+                        self.__watch_dir(prog, dirname(p), False)
+                elif isinstance(c, ConfigOLeveldb):
+                    if isdir(p):
+                        self.__add_watch(prog, p, False, True)
+
+    def __stop_watch(self):
+        if self._ino is not None:
+            self._ino.close()
+            self._ino = None
+            self._wd.clear()
+
+    def __touch(self, prog: Program, p: str):
+        if prog not in self._rescan:
+            self._paths.setdefault(prog, set()).add(p)
+
+    def __watch_dir(self, prog: Program, d: str, recursive: bool):
+        if not isdir(d):
+            return
+        if not recursive:
+            self.__add_watch(prog, d, False)
+            return
+        for root, _, _ in walk(d):
+            self.__add_watch(prog, root, True)
+
+    def run(self):
+        try:
+            if have_inotify:
+                self.__setup()
+            self._rescan.update(self.progs)
+            self.__backup()
+            if self._ino is not None:
+                print('Watching files...')
+            while self._ino is not None:
+                # Changes found after last round are pending, only debounce.
+                pending = self._paths or self._rescan
+                events = self._ino.read(
+                    self.cfg.watch_debounce if pending else None)
+                while events and self._ino is not None:
+                    for wd, mask, name in events:
+                        self.__handle(wd, mask, name)
+                    if self._ino is not None:
+                        events = self._ino.read(self.cfg.watch_debounce)
+                self.__backup()
+            self.__rescan_loop()
+        finally:
+            self.__stop_watch()
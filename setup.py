@@ -17,6 +17,7 @@ if '--without-zstd' in sys.argv:
     sys.argv.remove('--without-zstd')
 else:
     ext_modules.append(Extension("game_backuper._zstd", ["game_backuper/_zstd.pyx"], libraries=["zstd"]))
+ext_modules.append(Extension("game_backuper._fastcdc", ["game_backuper/_fastcdc.pyx"]))
 
 setup(
     name="game-backuper",
@@ -43,6 +44,8 @@ setup(
         "lzip": "lzip",
         "snappy": "python-snappy",
         "brotli": "brotli",
+        "blake3": "blake3",
+        "xxhash": "xxhash",
     },
     python_requires=">=3.6"
 )
@@ -0,0 +1,83 @@
+from os import mkdir, urandom, walk
+from os.path import join
+from sqlite3 import connect
+from subprocess import DEVNULL, run
+from sys import executable
+from tempfile import TemporaryDirectory
+
+
+def write_config(base: str, progs):
+    '''progs is a list of (name, extra options).'''
+    s = f'''dest: {join(base, 'dest')}
+chunked: true
+programs:
+'''
+    for name, extra in progs:
+        s += f'''  - name: {name}
+    base: {join(base, 'src')}
+    files:
+      - save.bin
+'''
+        for i in extra:
+            s += f'    {i}\n'
+    with open(join(base, 'cfg.yaml'), 'w') as f:
+        f.write(s)
+
+
+def backup(base: str, *progs: str):
+    run([executable, '-m', 'game_backuper', '-c', join(base, 'cfg.yaml'),
+         'backup', *progs], check=True, stdout=DEVNULL)
+
+
+def plain_chunks(base: str) -> int:
+    '''Return the number of chunk files containing the secret.'''
+    r = 0
+    for root, _, files in walk(join(base, 'dest', '.chunks')):
+        for i in files:
+            with open(join(root, i), 'rb') as f:
+                if b'TOP SECRET' in f.read():
+                    r += 1
+    return r
+
+
+def chunks_of(base: str, prog: str):
+    '''Return (key, compressed) of all chunks used by prog.'''
+    with connect(join(base, 'dest', 'data.db')) as db:
+        cur = db.execute('SELECT chunks.key, chunks.compressed FROM files JOIN file_chunks ON files.id=file_chunks.id LEFT JOIN chunks ON file_chunks.hash=chunks.hash WHERE files.program=?;', (prog,))  # noqa: E501
+        return cur.fetchall()
+
+
+def setup(base: str):
+    mkdir(join(base, 'src'))
+    with open(join(base, 'src', 'save.bin'), 'wb') as f:
+        f.write(data)
+
+
+data = (b'TOP SECRET' * 6554 + urandom(65536)) * 4
+# Programs with different settings share the same content.
+with TemporaryDirectory() as base:
+    setup(base)
+    write_config(base, [('pub', []), ('priv', ['encrypt_files: true']),
+                        ('gz', ['compress_method: gzip'])])
+    backup(base, 'pub')
+    n = plain_chunks(base)
+    assert n > 0
+    backup(base, 'priv', 'gz')
+    ch = chunks_of(base, 'priv')
+    assert ch and all(k is not None for k, _ in ch)
+    ch = chunks_of(base, 'gz')
+    assert ch and all(k is None and c is not None for k, c in ch)
+    assert all(k is None and c is None for k, c in chunks_of(base, 'pub'))
+    assert plain_chunks(base) == n
+# A program which was not encrypted before.
+with TemporaryDirectory() as base:
+    setup(base)
+    write_config(base, [('pub', []), ('priv', [])])
+    backup(base)
+    assert all(k is None for k, _ in chunks_of(base, 'priv'))
+    write_config(base, [('pub', []), ('priv', ['encrypt_files: true'])])
+    backup(base)
+    ch = chunks_of(base, 'priv')
+    assert ch and all(k is not None for k, _ in ch)
+    assert all(k is None for k, _ in chunks_of(base, 'pub'))
+print('ok')
@@ -1,7 +1,12 @@
 from game_backuper.compress import CompressConfig
-from game_backuper.enc import DecryptException, EncFile
+from game_backuper.enc import DecryptException, EncFile, EncFormat
+from game_backuper.enc import GCM_CHUNK, GCM_TAG
+import game_backuper.enc as enc
+import os
 from os import urandom, remove
 from hashlib import sha512
+from signal import SIGKILL
+from time import perf_counter, sleep
 from zlib import crc32
 
 
@@ -28,6 +33,92 @@ with EncFile('a.txt', 'rb', b'', key, iv, datalen, crc) as f:
     except DecryptException:
         pass
 remove('a.txt')
+# GCM format. Sizes around the chunk size, with and without compression.
+for datalen in (0, GCM_CHUNK, GCM_CHUNK + 1):
+    data = urandom(datalen)
+    for c in (None, CompressConfig('gzip', 9)):
+        with EncFile('a.txt', 'wb', b'', compress=c, format=EncFormat.GCM) as f:  # noqa: E501
+            f.write(data)
+            f.flush()
+            key = f.key
+            iv = f.iv
+        le = f.tell() if c else datalen
+        crc = f.crc32
+        with EncFile('a.txt', 'rb', b'', key, iv, le, crc, c, EncFormat.GCM) as f:  # noqa: E501
+            assert data == f.read()
+    remove('a.txt')
+# A truncated file or a modified chunk must be detected.
+datalen = GCM_CHUNK + 1
+data = urandom(datalen)
+with EncFile('a.txt', 'wb', b'', format=EncFormat.GCM) as f:
+    f.write(data)
+    key = f.key
+    iv = f.iv
+    crc = f.crc32
+with open('a.txt', 'rb') as f:
+    raw = f.read()
+assert len(raw) == datalen + 2 * GCM_TAG
+modified = bytearray(raw)
+modified[GCM_CHUNK + GCM_TAG + 1] ^= 1
+for b in (raw[:GCM_CHUNK + GCM_TAG], raw[:-1], bytes(modified)):
+    with open('a.txt', 'wb') as f:
+        f.write(b)
+    try:
+        with EncFile('a.txt', 'rb', b'', key, iv, datalen, crc, format=EncFormat.GCM) as f:  # noqa: E501
+            f.read()
+        assert False
+    except DecryptException:
+        pass
+remove('a.txt')
+# Seek in GCM format.
+datalen = 3 * GCM_CHUNK + 4096
+data = urandom(datalen)
+with EncFile('a.txt', 'wb', b'', format=EncFormat.GCM) as f:
+    f.write(data)
+    key = f.key
+    iv = f.iv
+    crc = f.crc32
+with EncFile('a.txt', 'rb', b'', key, iv, datalen, crc, format=EncFormat.GCM) as f:  # noqa: E501
+    assert f.seekable()
+    for off in (GCM_CHUNK + 5, 0, GCM_CHUNK - 1, 2 * GCM_CHUNK, datalen - 10, datalen):  # noqa: E501
+        assert f.seek(off) == off
+        assert f.read(4096) == data[off:off + 4096]
+        assert f.tell() == min(off + 4096, datalen)
+    assert f.seek(-100, 2) == datalen - 100
+    assert f.read() == data[-100:]
+    f.seek(10)
+    assert f.seek(GCM_CHUNK, 1) == GCM_CHUNK + 10
+    assert f.read(10) == data[GCM_CHUNK + 10:GCM_CHUNK + 20]
+remove('a.txt')
+# A forked child must not wait on the GCM pool of the parent.
+if hasattr(os, 'fork'):
+    cpu_count = enc.cpu_count
+    enc.cpu_count = lambda: 4
+    datalen = 8 * GCM_CHUNK
+    data = urandom(datalen)
+    with EncFile('a.txt', 'wb', b'', format=EncFormat.GCM) as f:
+        f.write(data)
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            with EncFile('a.txt', 'wb', b'', format=EncFormat.GCM) as f:
+                f.write(data)
+            code = 0
+        finally:
+            os._exit(code)
+    for i in range(200):
+        r, status = os.waitpid(pid, os.WNOHANG)
+        if r:
+            assert os.waitstatus_to_exitcode(status) == 0
+            break
+        sleep(0.1)
+    else:
+        os.kill(pid, SIGKILL)
+        os.waitpid(pid, 0)
+        assert False, 'Forked child hangs.'
+    enc.cpu_count = cpu_count
+    remove('a.txt')
 with EncFile('a.txt', 'wb', b'', compress=CompressConfig('gzip', 9)) as f:
     f.write(data)
     f.flush()
@@ -98,3 +189,29 @@ crc = f.crc32
 with EncFile('a.txt', 'rb', b'', key, iv, le, crc, CompressConfig('brotli', 1)) as f:  # noqa: E501
     assert data == f.read()
 remove('a.txt')
+# Throughput of reading a 64 MiB encrypted file.
+datalen = 64 * 1048576
+data = urandom(datalen)
+with EncFile('a.txt', 'wb', b'') as f:
+    for i in range(0, datalen, 1048576):
+        f.write(data[i:i + 1048576])
+    key = f.key
+    iv = f.iv
+    crc = f.crc32
+for bs in (4096, 65536, 1048576):
+    t = perf_counter()
+    with EncFile('a.txt', 'rb', b'', key, iv, datalen, crc) as f:
+        d = b''.join(iter(lambda: f.read(bs), b''))
+    t = perf_counter() - t
+    assert d == data
+    print(f'read({bs}): {datalen / t / 1048576:.1f} MiB/s')
+buf = bytearray(1048576)
+t = perf_counter()
+with EncFile('a.txt', 'rb', b'', key, iv, datalen, crc) as f:
+    with memoryview(buf) as v:
+        n = f.readinto(v)
+        while n:
+            n = f.readinto(v)
+t = perf_counter() - t
+print(f'readinto(1048576): {datalen / t / 1048576:.1f} MiB/s')
+remove('a.txt')
@@ -0,0 +1,40 @@
+from game_backuper.enc import EncFile, EncFormat, GCM_CHUNK, decrypt_file
+from game_backuper.enc import encrypt_file
+import game_backuper.enc as enc
+from game_backuper.file import File
+from game_backuper.scheduler import new_process_pool, run_in_pool
+from os import remove, urandom
+from os.path import exists
+
+
+def main():
+    # Use the GCM thread pool in this process before workers are started.
+    enc.cpu_count = lambda: 4
+    datalen = 8 * GCM_CHUNK
+    data = urandom(datalen)
+    with EncFile('a.txt', 'wb', b'', format=EncFormat.GCM) as f:
+        f.write(data)
+    remove('a.txt')
+    with open('a.txt', 'wb') as f:
+        f.write(data)
+    nf = File(None, 'a.txt', datalen, 'test', *[None] * 7)
+    pool = new_process_pool(2)
+    try:
+        fut = pool.submit(encrypt_file, 'a.txt', 'b.txt', nf, 'a.txt',
+                          'test', None, True)
+        st, h = fut.result(timeout=60)
+        nf = File.from_encrypt_stats(st, nf._replace(hash=h))
+        run_in_pool(pool, decrypt_file, 'b.txt', 'c.txt', nf, 'a.txt',
+                    'test')
+        with open('c.txt', 'rb') as f:
+            assert f.read() == data
+    finally:
+        pool.shutdown()
+        for i in ('a.txt', 'b.txt', 'c.txt'):
+            if exists(i):
+                remove(i)
+    print('ok')
+
+
+if __name__ == "__main__":
+    main()